@@ -6,9 +6,13 @@ game tree.
 '''
 
 import sys
+import threading
+from collections import OrderedDict
 
-from gomill import sgf, boards, ascii_boards
+from gomill import sgf, sgf_grammar, boards, ascii_boards
+from helpers import write_atomically
 from random import randint
+from time import time
 
 adjacencies = [(-1,0),(0,-1),(1,0),(0,1)]
 
@@ -127,6 +131,15 @@ def get_sgf_from_file(filen):
     game = sgf.Sgf_game.from_string(string)
     return game
 
+def get_sgf_root_from_file(filen):
+    '''Returns an Sgf_game holding only the root node of the file, which
+    is enough for get_gameinfo_from_sgf.'''
+    with open(filen) as fileh:
+        root = sgf_grammar.read_sgf_root(fileh)
+    coarse_game = sgf_grammar.Coarse_game_tree()
+    coarse_game.sequence = [root]
+    return sgf.Sgf_game.from_coarse_game_tree(coarse_game)
+
 def argsconverter_get_gameinfo_from_file(row_index,filen):
     info = get_gameinfo_from_file(filen)
     info['filen'] = filen
@@ -136,7 +149,7 @@ def argsconverter_get_gameinfo_from_file(row_index,filen):
 
 def get_gameinfo_from_file(filen):
     try:
-        info = get_gameinfo_from_sgf(get_sgf_from_file(filen))
+        info = get_gameinfo_from_sgf(get_sgf_root_from_file(filen))
     except:
         print 'Something went wrong with',filen
         info = {'wname':'[color=ff0000]ERROR[/color] reading file'}
@@ -338,14 +351,112 @@ def get_variations_from_node(node):
                         vars.append((childmove[0],childmove[1],parent.index(child)+1))
     return vars
 
-def apply_node_to_board(board, node):
-    board = board.copy()
-    add_stones = []
-    remove_stones = []
-    empty_stones = []
-    add_playmarker = None
+class BoardSnapshot(object):
+    '''An immutable board position, stored as a tuple of row tuples.
+
+    A snapshot derived from another shares every row that the change
+    between them didn't touch, so a position that differs from its
+    parent by one stone costs one new row tuple plus the outer tuple,
+    rather than a full copy of the grid. The board attribute can be
+    indexed as board[row][col] just like a gomill Board.
+
+    Snapshots carry the Zobrist hash of their position, so they can be
+    compared and used as dict keys without looking at the rows.'''
+    __slots__ = ('board','side','hash')
+    def __init__(self, rows, hash):
+        self.board = rows
+        self.side = len(rows)
+        self.hash = hash
+    def __hash__(self):
+        return hash(self.hash)
+    def __eq__(self, other):
+        if not isinstance(other, BoardSnapshot):
+            return NotImplemented
+        return self.hash == other.hash and self.board == other.board
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+    @classmethod
+    def empty(cls, side):
+        row = (None,) * side
+        return cls((row,) * side, 0)
+    @classmethod
+    def from_board(cls, board):
+        return cls(tuple(tuple(row) for row in board.board),
+                   board.zobrist_hash())
+    def get(self, row, col):
+        return self.board[row][col]
+    def to_board(self):
+        '''Returns a new mutable gomill Board holding this position.'''
+        board = boards.Board(self.side)
+        board.board = [list(row) for row in self.board]
+        board._is_empty = not any(any(row) for row in self.board)
+        board._hash = self.hash
+        return board
+    def derive(self, board, delta):
+        '''Returns the snapshot of board, which must equal this snapshot
+        with delta applied. Only the rows named in delta are copied.'''
+        added, removed = delta
+        if not added and not removed:
+            return self
+        rows = list(self.board)
+        for coords, colour in added + removed:
+            row = coords[0]
+            if rows[row] is self.board[row]:
+                rows[row] = tuple(board.board[row])
+        return BoardSnapshot(tuple(rows), board.zobrist_hash())
+    def apply_delta(self, delta):
+        '''Returns a new snapshot with delta applied, e.g. the parent
+        position given a node's inverted delta.'''
+        added, removed = delta
+        zobrist = boards.get_zobrist_table(self.side)
+        newhash = self.hash
+        rows = list(self.board)
+        changed = {}
+        for coords, colour in removed:
+            changed.setdefault(coords[0], {})[coords[1]] = None
+            newhash ^= zobrist[colour][coords[0]][coords[1]]
+        for coords, colour in added:
+            changed.setdefault(coords[0], {})[coords[1]] = colour
+            newhash ^= zobrist[colour][coords[0]][coords[1]]
+        for row, cols in changed.iteritems():
+            newrow = list(rows[row])
+            for col, colour in cols.iteritems():
+                newrow[col] = colour
+            rows[row] = tuple(newrow)
+        return BoardSnapshot(tuple(rows), newhash)
+    def list_occupied_points(self):
+        result = []
+        for row, rowcontents in enumerate(self.board):
+            for col, colour in enumerate(rowcontents):
+                if colour is not None:
+                    result.append((colour, (row, col)))
+        return result
+    def as_lists(self):
+        return [list(row) for row in self.board]
+
+def apply_node_to_board(snapshot, node):
+    newsnapshot, delta = apply_node_stones(snapshot, node)
+    instructions = get_instructions_from_delta(delta)
 
-    current_occupied_points = board.list_occupied_points()
+    nonstone_instructions = get_nonstone_from_node(node)
+    instructions.update(nonstone_instructions)
+
+    #instructions.update(setup_stones)
+
+    return (newsnapshot, instructions, delta)
+
+def apply_node_stones(snapshot, node):
+    '''Applies the setup stones and move of node to snapshot, returning
+    the new snapshot and the (added, removed) delta between them.'''
+    board = snapshot.to_board()
+
+    # Colour of each point touched by this node before the node was
+    # applied, so the stone changes can be read off without scanning
+    # the whole board.
+    touched = {}
 
     # First, find and deal with setup stones
     if node.has_setup_stones():
@@ -354,67 +465,78 @@ def apply_node_to_board(board, node):
         if len(setup_stones) > 0:
             for stone in setup_stones:
                 coords,col = stone
+                if coords not in touched:
+                    touched[coords] = board.board[coords[0]][coords[1]]
                 if col in ['b','w']:
-                    board.board[coords[0]][coords[1]] = col
+                    board.set(coords[0],coords[1],col)
                 elif col == 'e':
-                    board.board[coords[0]][coords[1]] = None
+                    board.set(coords[0],coords[1],None)
             
 
     # Now deal with the actual new move, if any
 
     new_move_colour, new_move_point = node.get_move()
     if new_move_point is not None:
+        if new_move_point not in touched:
+            touched[new_move_point] = board.board[new_move_point[0]][new_move_point[1]]
         try:
-            board.play(new_move_point[0],new_move_point[1],new_move_colour)
+            ko_point, captured = board.play_with_captures(new_move_point[0],new_move_point[1],new_move_colour)
+            for colour, point in captured:
+                if point not in touched:
+                    touched[point] = colour
         except ValueError:
             print 'SGF played existing point'
-            board.board[new_move_point[0]][new_move_point[1]] = new_move_colour
-    new_occupied_points = board.list_occupied_points()
-    for point in new_occupied_points:
-        if point not in current_occupied_points:
-            add_stones.append((point[1],point[0]))
-    for point in current_occupied_points:
-        if point not in new_occupied_points:
-            remove_stones.append((point[1],point[0]))
-
-
+            board.set(new_move_point[0],new_move_point[1],new_move_colour)
+
+    delta = get_delta_from_touched(board, touched)
+    return (snapshot.derive(board, delta), delta)
+
+def get_delta_from_touched(board, touched):
+    '''Takes a board and a dict of the previous colour at every point
+    that may have changed, and returns the net change as a pair
+    (added, removed) of lists of (coords, colour).'''
+    added = []
+    removed = []
+    for coords, oldcolour in touched.iteritems():
+        newcolour = board.board[coords[0]][coords[1]]
+        if newcolour == oldcolour:
+            continue
+        if oldcolour is not None:
+            removed.append((coords, oldcolour))
+        if newcolour is not None:
+            added.append((coords, newcolour))
+    return (added, removed)
+
+def invert_delta(delta):
+    added, removed = delta
+    return (removed, added)
+
+def get_instructions_from_delta(delta):
+    added, removed = delta
     instructions = {}
-    if len(add_stones) > 0:
-        instructions['add'] = add_stones
-    if len(remove_stones) > 0:
-        instructions['remove'] = remove_stones
-    if len(empty_stones) > 0:
-        instructions['empty'] = empty_stones
-
-    nonstone_instructions = get_nonstone_from_node(node)
-    instructions.update(nonstone_instructions)
-
-    #instructions.update(setup_stones)
-
-    return (board, instructions)
-
-
+    if len(added) > 0:
+        instructions['add'] = added
+    if len(removed) > 0:
+        instructions['remove'] = removed
+    return instructions
 
 def compare_boards(old, new):
-    add_stones = []
-    remove_stones = []
-
-    old_stones = old.list_occupied_points()
-    new_stones = new.list_occupied_points()
-    for point in new_stones:
-        if point not in old_stones:
-            add_stones.append((point[1],point[0]))
-    for point in old_stones:
-        if point not in new_stones:
-            remove_stones.append((point[1],point[0]))
-
-    instructions = {}
-    if len(add_stones) > 0:
-        instructions['add'] = add_stones
-    if len(remove_stones) > 0:
-        instructions['remove'] = remove_stones
-
-    return instructions
+    added = []
+    removed = []
+    for row, (oldrow, newrow) in enumerate(zip(old.board, new.board)):
+        # Snapshots share unchanged rows, so most are skipped here
+        if oldrow is newrow or oldrow == newrow:
+            continue
+        for col in range(len(oldrow)):
+            oldcolour = oldrow[col]
+            newcolour = newrow[col]
+            if oldcolour == newcolour:
+                continue
+            if oldcolour is not None:
+                removed.append(((row, col), oldcolour))
+            if newcolour is not None:
+                added.append(((row, col), newcolour))
+    return get_instructions_from_delta((added, removed))
 
 def get_nonstone_from_node(node):
     instructions = {}
@@ -505,28 +627,185 @@ def get_comment_from_node(node):
     
     
 
+class PositionCache(object):
+    '''Size-bounded LRU of the positions of every open AbstractBoard,
+    checkpoints included. Evicting a position just makes its owner
+    forget it; it is rebuilt from the nearest stored ancestor when next
+    needed. The counters are there to tune max_positions per device.'''
+    def __init__(self, max_positions=2000):
+        self.max_positions = max_positions
+        self.entries = OrderedDict() # node -> owning AbstractBoard
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    def __str__(self):
+        return 'PositionCache with {0}/{1} positions, {2} hits, {3} misses, {4} evictions'.format(
+            len(self.entries), self.max_positions, self.hits, self.misses, self.evictions)
+    def __repr__(self):
+        return self.__str__()
+    def set_max_positions(self, max_positions):
+        self.max_positions = max_positions
+        self.evict()
+    def add(self, owner, node):
+        if self.entries.has_key(node):
+            self.entries.pop(node)
+        self.entries[node] = owner
+        self.evict()
+    def record_hit(self, node):
+        self.hits += 1
+        if self.entries.has_key(node):
+            # Move to the most recently used end
+            self.entries[node] = self.entries.pop(node)
+    def record_miss(self):
+        self.misses += 1
+    def discard(self, node):
+        if self.entries.has_key(node):
+            self.entries.pop(node)
+    def discard_owner(self, owner):
+        for node, entryowner in self.entries.items():
+            if entryowner is owner:
+                self.entries.pop(node)
+    def evict(self):
+        entries = self.entries
+        if len(entries) <= self.max_positions:
+            return
+        for node, owner in entries.items():
+            if len(entries) <= self.max_positions:
+                break
+            if node is owner.curnode:
+                continue
+            entries.pop(node)
+            owner.forget_board(node)
+            self.evictions += 1
+    def stats(self):
+        return {'positions': len(self.entries),
+                'max_positions': self.max_positions,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+position_cache = PositionCache()
+
+class SgfSnapshot(object):
+    '''The raw properties of every node of a game, copied so that the
+    game can go on changing while the copy is serialised. Property values
+    are replaced rather than changed in place by gomill, so copying each
+    node's property map is enough.'''
+    def __init__(self, game):
+        try:
+            self.encoding = game.get_charset()
+        except ValueError:
+            raise ValueError("unsupported charset: %s" %
+                             game.root.get_raw_list("CA"))
+        self.root_encoding = game.root.get_encoding()
+        self.coarse_tree = sgf_grammar.make_coarse_game_tree(
+            game.root, lambda node:node,
+            lambda node:dict(node.get_raw_property_map()))
+    def serialise(self, wrap=79):
+        '''As Sgf_game.serialise, for the snapshot.'''
+        serialised = sgf_grammar.serialise_game_tree(self.coarse_tree, wrap)
+        if self.encoding == self.root_encoding:
+            return serialised
+        return serialised.decode(self.root_encoding).encode(self.encoding)
+
+class SgfSaver(object):
+    '''Serialises and writes SgfSnapshots on a worker thread, in the
+    order they were queued. A file queued again before it has been
+    written is only written once, with the newest snapshot.'''
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = OrderedDict() # filen -> (snapshot, callback)
+        self.writing = None
+        self.thread = None
+    def __str__(self):
+        return 'SgfSaver with {0} saves pending'.format(len(self.pending))
+    def __repr__(self):
+        return self.__str__()
+    def save(self, filen, snapshot, callback=None):
+        '''Queues a snapshot to be written to filen. callback is called
+        from the worker thread once the file has been written.'''
+        with self.condition:
+            self.pending.pop(filen, None)
+            self.pending[filen] = (snapshot, callback)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify_all()
+    def is_busy(self):
+        with self.condition:
+            return len(self.pending) > 0 or self.writing is not None
+    def wait(self, timeout=None):
+        '''Blocks until every queued save has been written, or until
+        timeout seconds have passed. Returns True if nothing is left to
+        write.'''
+        if timeout is not None:
+            end = time() + timeout
+        with self.condition:
+            while self.pending or self.writing is not None:
+                if timeout is None:
+                    self.condition.wait()
+                else:
+                    remaining = end - time()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+        return True
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                filen, (snapshot, callback) = self.pending.popitem(last=False)
+                self.writing = filen
+            try:
+                write_atomically(filen, snapshot.serialise())
+                if callback is not None:
+                    callback()
+            except (IOError, OSError, ValueError) as e:
+                print 'Could not save sgf to', filen, e
+            with self.condition:
+                self.writing = None
+                self.condition.notify_all()
+
+sgf_saver = SgfSaver()
+
 class AbstractBoard(object):
-    def __init__(self,game=None,gridsize=19):
+    # Positions at every checkpoint_interval'th ply of a branch are kept
+    # as checkpoints when a branch is replayed, so a missing board is
+    # usually rebuilt from at most that many nodes. Every position,
+    # checkpoints included, counts against the shared position_cache.
+    # The stone delta of each node from its parent is kept after its
+    # board is evicted, so retreating never needs a replay.
+    checkpoint_interval = 25
+
+    def __init__(self,game=None,gridsize=19,checkpoint_interval=None):
         if game is None:
             game = sgf.Sgf_game(gridsize)
         print 'abstractboard initialised with size', game.size, gridsize
 
+        if checkpoint_interval is not None:
+            self.checkpoint_interval = checkpoint_interval
+
         self.game = game
         self.prisoners = [0,0]
         self.variation_index = 0
 
-        self.boards = {}
-        self.curnode = game.get_root()
-        board = boards.Board(self.game.size)
-        board, instructions = apply_node_to_board(board,self.curnode)
-        self.boards[self.curnode] = board
         self.varcache = {}
         self.filepath = ''
+        # Tree changes are counted, and a board is dirty until the
+        # change count it was last saved at catches up
+        self.changes = 0
+        self.saved_changes = 0
+        self.curnode = game.get_root()
+        self.clear_boards()
+        board = BoardSnapshot.empty(self.game.size)
+        board, instructions, delta = apply_node_to_board(board,self.curnode)
+        self.store_board(self.curnode, board, delta, 0)
 
     def get_current_boardpos(self):
         curnode = self.curnode
-        newboard = [row[:] for row in self.boards[curnode].board]
-        return newboard
+        return self.boards[curnode].as_lists()
 
     def get_reconstruction(self):
         curnode = self.curnode
@@ -571,6 +850,7 @@ class AbstractBoard(object):
             print 'Failed to parse string'
             self.game = sgf.Sgf_game(19)
         print 'loaded from file'
+        self.saved_changes = self.changes
         self.reset_position()
         print 'reset position'
 
@@ -584,30 +864,43 @@ class AbstractBoard(object):
         if 'filepath' in info:
             self.filepath = info['filepath']
         set_gameinfo_in_sgf(info,self.game)
-
-    def save_sgf(self,filen):
-        data = self.game.serialise()
-        fileh = open(filen,'w')
-        fileh.write(data)
-        fileh.close()
+        self.mark_dirty()
+
+    def mark_dirty(self):
+        self.changes += 1
+
+    def is_dirty(self):
+        return self.changes != self.saved_changes
+
+    def save_sgf(self,filen,wait=False):
+        '''Snapshots the game and queues it to be written to filen by the
+        sgf_saver. If wait is True, blocks until it has been written.'''
+        snapshot = SgfSnapshot(self.game)
+        changes = self.changes
+        def saved():
+            self.saved_changes = changes
+        sgf_saver.save(filen, snapshot, saved)
+        if wait:
+            return sgf_saver.wait()
         return True
-        
 
     def load_sgf_from_text(self, sgftext):
         self.game = sgf.Sgf_game.from_string(sgftext)
+        self.mark_dirty()
         self.reset_position()
 
     def set_sgf(self,sgf):
         self.game = sgf
+        self.mark_dirty()
         self.reset_position()
 
     def reset_position(self):
         self.curnode = self.game.get_root()
-        self.boards = {}
+        self.clear_boards()
         self.varcache = {}
-        board = boards.Board(self.game.size)
-        board, instructions = apply_node_to_board(board,self.curnode)
-        self.boards[self.curnode] = board
+        board = BoardSnapshot.empty(self.game.size)
+        board, instructions, delta = apply_node_to_board(board,self.curnode)
+        self.store_board(self.curnode, board, delta, 0)
         node_index = self.current_node_index()
         instructions.update({'nodeindex': node_index})
         return instructions
@@ -642,12 +935,10 @@ class AbstractBoard(object):
                 newnode = self.curnode[0]
 
         self.curnode = newnode
-        newboard = curboard.copy()
-        
-        newboard, instructions = apply_node_to_board(newboard, newnode)
+        newboard, instructions, delta = apply_node_to_board(curboard, newnode)
 #        instructions = {'add':[((randint(0,18),randint(0,18)),['w','b'][randint(0,1)])],'playmarker': (randint(0,18),randint(0,18)), 'nextplayer': ['w','b'][randint(0,1)]}
 
-        self.boards[newnode] = newboard
+        self.store_board(newnode, newboard, delta, self.depths[curnode] + 1)
 
         node_index = self.current_node_index()
         instructions.update({'nodeindex': node_index})
@@ -664,14 +955,23 @@ class AbstractBoard(object):
             return None
 
         self.curnode = newnode
-        if self.boards.has_key(newnode):
-            newboard = self.boards[newnode]
-        else:
-            print 'Reconstruct board'
-
-        self.boards[newnode] = newboard
 
-        instructions = compare_boards(curboard, newboard)
+        if self.deltas.has_key(curnode):
+            inverse = invert_delta(self.deltas[curnode])
+            if self.boards.has_key(newnode):
+                position_cache.record_hit(newnode)
+            else:
+                position_cache.record_miss()
+                # Step back through the delta rather than replaying
+                # from the last checkpoint. newnode's own delta is
+                # still known, so the next retreat can do the same.
+                newboard = curboard.apply_delta(inverse)
+                self.store_board(newnode, newboard, self.deltas.get(newnode),
+                                 self.depths[curnode] - 1)
+            instructions = get_instructions_from_delta(inverse)
+        else:
+            newboard = self.get_or_build_board(newnode)
+            instructions = compare_boards(curboard, newboard)
 
         nonstone_instructions = get_nonstone_from_node(newnode)
         instructions.update(nonstone_instructions)
@@ -772,6 +1072,7 @@ class AbstractBoard(object):
         curmove = curnode.get_move()
         if curmove[0] is not None:
             curnode = self.curnode.new_child()
+            self.mark_dirty()
             instructions = self.jump_to_node(curnode)
         else:
             instructions = {}
@@ -811,11 +1112,13 @@ class AbstractBoard(object):
             if coords in ae:
                 ae.remove(coords)
         curnode.set_setup_stones(ab,aw,ae)
+        self.mark_dirty()
         if curnode.parent is not None:
             self.rebuild_curboard()
     def rebuild_curboard(self):
-        if self.curnode in self.boards:
-            curboard = self.boards.pop(self.curnode)
+        # Boards and deltas below this node were built on the old
+        # position, so they have to go too.
+        self.recursively_destroy_boards_from(self.curnode)
         self.build_boards_to_node(self.curnode)
     def add_add_stone(self,coords,colour='b'):
         curnode = self.curnode
@@ -834,6 +1137,7 @@ class AbstractBoard(object):
                 ae.add(coords)
                 #curboard.board[coords[0]][coords[1]] = None
         curnode.set_setup_stones(ab,aw,ae)
+        self.mark_dirty()
         if curnode.parent is not None:
             self.rebuild_curboard()
 
@@ -848,6 +1152,7 @@ class AbstractBoard(object):
                     node.set('TR',node_markers)
                 else:
                     node.unset('TR')
+                self.mark_dirty()
         if 'SQ' in properties:
             node_markers = node.find_property('SQ')
             if coords in node_markers:
@@ -856,6 +1161,7 @@ class AbstractBoard(object):
                     node.set('SQ',node_markers)
                 else:
                     node.unset('SQ')
+                self.mark_dirty()
         if 'CR' in properties:
             node_markers = node.find_property('CR')
             if coords in node_markers:
@@ -864,6 +1170,7 @@ class AbstractBoard(object):
                     node.set('CR',node_markers)
                 else:
                     node.unset('CR')
+                self.mark_dirty()
         if 'MA' in properties:
             node_markers = node.find_property('MA')
             if coords in node_markers:
@@ -872,6 +1179,7 @@ class AbstractBoard(object):
                     node.set('MA',node_markers)
                 else:
                     node.unset('MA')
+                self.mark_dirty()
 
     def add_marker_at(self, mtype, coords):
         node = self.curnode
@@ -892,6 +1200,7 @@ class AbstractBoard(object):
                 node_markers = set()
             node_markers.add(coords)
             node.set(code,node_markers)
+            self.mark_dirty()
         
 
     def add_new_node(self,coord,colour,newmainline=False,jump=True,disallowsuicide=False):
@@ -912,6 +1221,7 @@ class AbstractBoard(object):
             newnode = self.curnode.new_child(0)
         if coord is not None:
             newnode.set_move(colour,coord)
+        self.mark_dirty()
         #print 'newnode is',newnode
         if jump:
             instructions = self.jump_to_node(newnode)
@@ -926,6 +1236,7 @@ class AbstractBoard(object):
         else:
             newnode = self.curnode[0]
         newnode.set_move(colour,coord)
+        self.mark_dirty()
         self.recursively_destroy_boards_from(newnode)
         return self.jump_to_node(newnode)
 
@@ -937,12 +1248,16 @@ class AbstractBoard(object):
 
         self.add_new_node(coord,colour,jump=False)
         reparentnode.reparent(self.curnode[-1])
+        self.mark_dirty()
         self.recursively_destroy_boards_from(reparentnode)
         return self.jump_to_node(self.curnode[-1])
 
     def recursively_destroy_boards_from(self,node):
-        if self.boards.has_key(node):
-            deadboard = self.boards.pop(node)
+        self.forget_board(node)
+        if self.deltas.has_key(node):
+            self.deltas.pop(node)
+        if self.hashes.has_key(node):
+            self.hashes.pop(node)
         for child in node:
             self.recursively_destroy_boards_from(child)
 
@@ -967,28 +1282,77 @@ class AbstractBoard(object):
         return newnode.get_move()[1]
 
     def get_or_build_board(self, node):
-        if not self.boards.has_key(node):
-            self.build_boards_to_node(node)
-        return self.boards[node]
+        if self.boards.has_key(node):
+            position_cache.record_hit(node)
+            return self.boards[node]
+        position_cache.record_miss()
+        # The built board may already have been evicted if the cache is
+        # small, so it is taken from the return value
+        return self.build_boards_to_node(node)
 
     def build_boards_to_node(self, node, replace=False):
+        '''Replays the nodes down to node, storing its position and any
+        checkpoints passed. Returns the position at node.'''
         #print 'build_boards_to_node called'
-        precursor_nodes = self.game.get_sequence_above(node)
-        board = boards.Board(self.game.size)
-        board, instructions = apply_node_to_board(board,precursor_nodes[0])
-        self.boards[precursor_nodes[0]] = board
-
-        for i in range(1,len(precursor_nodes)):
-            curnode = precursor_nodes[i]
-            if (not self.boards.has_key(curnode)) or replace:
-                board, instructions = apply_node_to_board(board, curnode)
-                self.boards[curnode] = board
-            else:
-                board = self.boards[curnode]
-
-        curnode = node
-        board, instructions = apply_node_to_board(board, node)
+        # Find the nearest ancestor with a stored position (at worst a
+        # checkpoint) and replay only the nodes below it.
+        path = [node]
+        ancestor = node.parent
+        while ancestor is not None and (replace or not self.boards.has_key(ancestor)):
+            path.append(ancestor)
+            ancestor = ancestor.parent
+        if ancestor is None:
+            board = BoardSnapshot.empty(self.game.size)
+            depth = -1
+        else:
+            board = self.boards[ancestor]
+            depth = self.depths[ancestor]
+
+        for curnode in reversed(path):
+            depth += 1
+            board, delta = apply_node_stones(board, curnode)
+            self.hashes[curnode] = board.hash
+            if curnode is node or depth % self.checkpoint_interval == 0:
+                self.store_board(curnode, board, delta, depth)
+        return board
+
+    def store_board(self, node, board, delta, depth):
+        '''Stores the position at node, which is depth plies from the
+        root. delta may be None if the change from the parent position
+        isn't known.'''
         self.boards[node] = board
+        self.depths[node] = depth
+        self.hashes[node] = board.hash
+        if delta is not None:
+            self.deltas[node] = delta
+        position_cache.add(self, node)
+
+    def forget_board(self, node):
+        '''Forgets the position at node. Its delta and hash are kept, as
+        they stay valid until the tree above node changes.'''
+        if self.boards.has_key(node):
+            self.boards.pop(node)
+            self.depths.pop(node)
+        position_cache.discard(node)
+
+    def clear_boards(self):
+        '''Forgets every stored position, including any held in the
+        shared position cache.'''
+        position_cache.discard_owner(self)
+        self.boards = {}
+        self.deltas = {}
+        self.depths = {}
+        self.hashes = {}
+
+    def get_position_hash(self, node=None):
+        '''Returns the Zobrist hash of the position at node (by default
+        the current node). Hashes outlive evicted boards, so this only
+        rebuilds a board if node has never been visited.'''
+        if node is None:
+            node = self.curnode
+        if not self.hashes.has_key(node):
+            self.get_or_build_board(node)
+        return self.hashes[node]
 
     def get_result(self):
         return get_result_from_sgf(self.game)
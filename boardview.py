@@ -31,6 +31,7 @@ from kivy.uix.slider import Slider
 from kivy.uix.screenmanager import ScreenManager, Screen
 from kivy.uix.screenmanager import *
 from kivy.adapters.listadapter import ListAdapter
+from mylistview import ListModel, ModelListAdapter
 from kivy.uix.listview import ListView, ListItemButton
 from kivy.utils import platform
 from kivy.animation import Animation
@@ -48,7 +49,7 @@ from random import choice
 from math import sin
 from functools import partial
 from glob import glob
-from os.path import abspath
+from os.path import abspath, exists
 from os import mkdir
 from json import dump as jsondump, load as jsonload, dump as jsondump
 import json
@@ -58,11 +59,15 @@ from shutil import copyfile
 
 from gomill import sgf, boards
 from abstractboard import *
-from sgfcollections import CollectionChooserButton, get_collectioninfo_from_collection
+from sgfcollections import CollectionChooserButton, get_collectioninfo_from_collection, PositionResultButton, get_position_result_info
+from positionindex import PositionIndex, get_index, find_position_in_collections
+from patternindex import PatternIndex, find_patterns_in_collections
 from widgetcache import WidgetCache
-from boardwidgets import Stone, TextMarker, TriangleMarker, SquareMarker, CircleMarker, CrossMarker, VarStone, WhiteStoneSimple, BlackStoneSimple
+from miscwidgets import MySpinnerOption
+from boardwidgets import StoneLayer, TextMarker, TriangleMarker, SquareMarker, CircleMarker, CrossMarker
 
 import sys
+import threading
 
 navigate_text = '[b]Navigation mode[/b] selected. Tap on the right side of the board to advance the game, or the left to move back.'
 edit_text = '[b]Edit mode[/b] selected. Use the edit tools below the board to add/remove SGF markers and stones.'
@@ -164,6 +169,10 @@ class ReversibleSpinner(BoxLayout):
 class VarPopup(Popup):
     pass
 
+class IndexProgress(Popup):
+    length = NumericProperty(1)
+    progress = NumericProperty(0)
+
 class BoardCarousel(Carousel):
     board = ObjectProperty()
     board_navmode = StringProperty('')
@@ -395,6 +404,118 @@ starposs = {19:[(3,3),(3,9),(3,15),(9,3),(9,9),(9,15),(15,3),(15,9),(15,15)],
             13:[(3,3),(3,9),(9,3),(9,9),(6,6)],
             9:[(2,2),(6,2),(2,6),(6,6),(4,4)]}
 
+class BoardGeometry(object):
+    '''The screen layout of a board: the position of every point with
+    the board's flips applied, the inverse mapping for touches, and the
+    gridline, starpoint and coordinate label positions. GuiBoard makes a
+    new one whenever its size, position, gridsize or flips change, so
+    lookups in between are just dict accesses.'''
+    def __init__(self, gridsize, origin, spacing, flips=(False,False,True,False),
+                 starpoints=[]):
+        self.gridsize = gridsize
+        self.origin = origin
+        self.spacing = spacing
+        self.flips = flips
+
+        self.positions = {}
+        self.grid_positions = {}
+        self.coords = {}
+        for i in range(gridsize):
+            for j in range(gridsize):
+                realcoord = self.transform((i,j))
+                self.positions[(i,j)] = self.screen_pos(realcoord)
+                self.grid_positions[(i,j)] = (realcoord[0]-0.5,realcoord[1]-0.5)
+                self.coords[realcoord] = (i,j)
+
+        self.gridlines = self.make_gridlines()
+        self.starpoints = [(coord, self.grid_positions[coord])
+                           for coord in starpoints if self.grid_positions.has_key(coord)]
+        self.letter_positions = [self.screen_pos((i,-0.75)) for i in range(gridsize)]
+        self.number_positions = [self.screen_pos((-0.75,j)) for j in range(gridsize)]
+
+    def transform(self, coord):
+        '''Returns where coord is drawn, in grid units.'''
+        flip_horiz, flip_vert, flip_forwardslash, flip_backslash = self.flips
+        last = self.gridsize - 1
+        x, y = coord
+        if flip_horiz:
+            x = last - x
+        if flip_vert:
+            y = last - y
+        if flip_forwardslash:
+            x, y = y, x
+        if flip_backslash:
+            x, y = last - y, last - x
+        return (x, y)
+
+    def untransform(self, coord):
+        '''The inverse of transform.'''
+        flip_horiz, flip_vert, flip_forwardslash, flip_backslash = self.flips
+        last = self.gridsize - 1
+        x, y = coord
+        if flip_backslash:
+            x, y = last - y, last - x
+        if flip_forwardslash:
+            x, y = y, x
+        if flip_vert:
+            y = last - y
+        if flip_horiz:
+            x = last - x
+        return (x, y)
+
+    def screen_pos(self, realcoord):
+        return (self.origin[0] + (realcoord[0]-0.5)*self.spacing,
+                self.origin[1] + (realcoord[1]-0.5)*self.spacing)
+
+    def grid_pos(self, coord):
+        '''Returns the lower left corner of coord's stone in grid units,
+        relative to origin, as used by the StoneLayer.'''
+        try:
+            return self.grid_positions[coord]
+        except (KeyError, TypeError):
+            realcoord = self.transform(tuple(coord))
+            return (realcoord[0]-0.5,realcoord[1]-0.5)
+
+    def coord_to_pos(self, coord, dotransformations=True):
+        if not dotransformations:
+            return self.screen_pos(coord)
+        try:
+            return self.positions[coord]
+        except (KeyError, TypeError):
+            # Off the board, or a list from a kivy property
+            return self.screen_pos(self.transform(tuple(coord)))
+
+    def pos_to_coord(self, pos, offset=(0,0)):
+        relx = (pos[0] - self.origin[0]) / self.spacing + offset[0]
+        rely = (pos[1] - self.origin[1]) / self.spacing + offset[1]
+        realcoord = (int(round(relx)),int(round(rely)))
+        coord = self.coords.get(realcoord)
+        if coord is None:
+            coord = self.untransform(realcoord)
+        return coord
+
+    def make_gridlines(self):
+        '''Returns the flat list of points of one line zigzagging along
+        every row and then every column.'''
+        length = self.spacing * (self.gridsize - 1)
+        curx, cury = self.origin
+        points = []
+        dir = 1.0
+        for y in range(self.gridsize - 1):
+            curx += dir*length
+            points.extend((curx,cury))
+            cury += self.spacing
+            points.extend((curx,cury))
+            dir *= -1
+        dir *= -1
+        for x in range(self.gridsize - 1):
+            cury += dir*length
+            points.extend((curx,cury))
+            curx += self.spacing
+            points.extend((curx,cury))
+            dir *= -1
+        return points
+
 class EditMarker(Widget):
     coord = ListProperty((0,0))
     board = ObjectProperty(None)
@@ -515,7 +636,7 @@ class GuiBoard(Widget):
     playmarker = ObjectProperty(None,allownone=True) # Circle marking last played move
     boardmarkers = DictProperty({})
     guesspopup = ObjectProperty(None,allownone=True)
-    varstones = DictProperty({})
+    varstones = DictProperty({}) # coord -> variation number
 
     # Coordinates widget
     coordinate_letter = 'abcdefghjklmnopqrstuv'
@@ -550,8 +671,12 @@ class GuiBoard(Widget):
     #     print 'board add_widget called with...',args
     #     super(GuiBoard,self).add_widget(*args)
 
-    stones = DictProperty({})
+    stones = DictProperty({}) # coord -> 'black' or 'white'
+    stone_layer = ObjectProperty(None,allownone=True)
     starpoints = DictProperty()
+
+    indexing = BooleanProperty(False) # Search indexes are being updated
+    index_progress = ObjectProperty(None,allownone=True)
     starpoint_positions = DictProperty(starposs)
 
     gobansize = ListProperty((100,100))
@@ -564,7 +689,21 @@ class GuiBoard(Widget):
     gobanpos = ListProperty((100,100))
 
     def __init__(self,*args,**kwargs):
+        self.pending_instructions = None
+        self.flush_trigger = Clock.create_trigger(self.flush_instructions)
+        self.geometry = None
         super(GuiBoard,self).__init__(*args,**kwargs)
+        self.bind(gridspacing=self.invalidate_geometry,
+                  boardindent=self.invalidate_geometry,
+                  gridsize=self.invalidate_geometry,
+                  flip_horiz=self.flips_changed,
+                  flip_vert=self.flips_changed,
+                  flip_forwardslash=self.flips_changed,
+                  flip_backslash=self.flips_changed)
+        self.stone_layer = StoneLayer(stone_type=App.get_running_app().stone_type)
+        self.add_widget(self.stone_layer)
+        self.update_stones()
+        self.draw_starpoints()
         print 'GuiBoard init, making abstractboard with gridsize', self.gridsize
         self.abstractboard = AbstractBoard(gridsize=self.gridsize)
         self.reset_abstractboard()
@@ -664,7 +803,7 @@ class GuiBoard(Widget):
     def email_sgf(self):
         if platform() == 'android':
             import android
-            self.save_sgf()
+            self.save_sgf(wait=True)
             filen = self.collectionsgf.filen
             copyfile(filen,'/sdcard/noGo/email_sgf.sgf')
             filen = '/sdcard/noGo/email_sgf.sgf'
@@ -680,19 +819,131 @@ class GuiBoard(Widget):
         popup.content.popup = popup
         popup.open()
 
-    def save_sgf(self,mode='quiet'):
+    def update_indexes(self,index_classes,callback):
+        '''Brings the search indexes of every collection up to date on a
+        worker thread, then calls callback on the main thread with the
+        collections and the updated indexes, as a dict of index class to
+        a dict of collection name to index. A progress bar is shown if
+        this takes a while.'''
+        if self.indexing:
+            return
+        app = App.get_running_app()
+        app.build_collections_list()
+        collections = app.collections.collections
+        jobs = []
+        for collection in collections:
+            collection.finish_lazy_loading()
+            filens = [game.filen for game in collection.games]
+            for index_class in index_classes:
+                jobs.append((collection.name,filens,index_class))
+        self.indexing = True
+        self.index_progress = IndexProgress(length=len(jobs))
+        thread = threading.Thread(target=self.background_update_indexes,args=(jobs,collections,callback))
+        thread.daemon = True
+        thread.start()
+        Clock.schedule_once(self.show_index_progress,0.5)
+    def background_update_indexes(self,jobs,collections,callback):
+        indexes = {}
+        try:
+            for number, (name,filens,index_class) in enumerate(jobs):
+                index = get_index(name,filens,index_class)
+                indexes.setdefault(index_class,{})[name] = index
+                Clock.schedule_once(partial(self.set_index_progress,number+1))
+        finally:
+            Clock.schedule_once(partial(self.finish_updating_indexes,collections,indexes,callback))
+    def set_index_progress(self,progress,*args):
+        self.index_progress.progress = progress
+    def show_index_progress(self,*args):
+        if self.indexing:
+            self.index_progress.open()
+    def finish_updating_indexes(self,collections,indexes,callback,*args):
+        self.indexing = False
+        Clock.unschedule(self.show_index_progress)
+        self.index_progress.dismiss()
+        callback(collections,indexes)
+
+    def find_position(self):
+        '''Opens a popup listing every game in the collections that passes
+        through the current position, once their indexes are up to
+        date.'''
+        position_hash = self.abstractboard.get_position_hash()
+        self.update_indexes([PositionIndex],partial(self.show_position_results,position_hash))
+    def show_position_results(self,position_hash,collections,indexes):
+        t1 = time()
+        results = find_position_in_collections(collections,position_hash,indexes.get(PositionIndex))
+        print 'position search found',len(results),'games in',time()-t1
+        psr = PositionSearchResults(board=self)
+        popup = Popup(content=psr,title='Games with this position ({0})'.format(len(results)),size_hint=(0.85,0.85))
+        psr.popup = popup
+        list_adapter = ModelListAdapter(model=ListModel(results),
+                                        args_converter = get_position_result_info,
+                                        selection_mode = 'single',
+                                        allow_empty_selection=True,
+                                        cls=PositionResultButton,
+                                        )
+        psr.results_list.adapter = list_adapter
+        popup.open()
+
+    def find_patterns(self):
+        '''Searches every collection for the corner and side shapes of the
+        current position, and shows the moves played next in them as
+        variation stones numbered by how often they were played. The
+        search runs once the pattern indexes are up to date.'''
+        if self.navmode not in ['Play','Navigate']:
+            self.comment_pre_text = '[b]Pattern search[/b]\nSwitch to Play or Navigate mode to find joseki.\n-----\n'
+            return
+        self.update_indexes([PatternIndex],partial(self.show_pattern_results,self.abstractboard.curnode))
+    def show_pattern_results(self,node,collections,indexes):
+        if self.abstractboard.curnode is not node:
+            # The board moved on while the indexes were updated
+            return
+        board = self.abstractboard.get_or_build_board(node)
+        t1 = time()
+        results = find_patterns_in_collections(collections,board.get,int(self.gridsize),indexes.get(PatternIndex))
+        print 'pattern search found',results,'in',time()-t1
+
+        lines = []
+        best = {}
+        for result in results:
+            lines.append('{0} shape: {1} games, {2} after tenuki'.format(result.kind,len(result.games),result.tenuki))
+            for (coord,colour), count in result.continuations.items():
+                if board.get(*coord) is None and count > best.get(coord,(0,''))[0]:
+                    best[coord] = (count,colour)
+        if len(lines) == 0:
+            lines.append('No games found with these shapes.')
+        skipped = sum([len(index.skipped) for index in indexes.get(PatternIndex,{}).values()])
+        if skipped > 0:
+            lines.append('{0} games could not be read and were skipped.'.format(skipped))
+
+        self.clear_variation_stones()
+        for coord in best:
+            count, colour = best[coord]
+            self.add_variation_stone(coord,colour,count)
+        self.comment_pre_text = '[b]Pattern search[/b]\n' + '\n'.join(lines) + '\n-----\n'
+
+    def save_sgf(self,mode='quiet',wait=False):
                 #saveas=False,autosave=False,refresh=True):
+        '''Saves the sgf in the background if it has changed since it was
+        last saved. With wait=True, returns once it has been written.'''
         filen = self.collectionsgf.filen
         if filen == '':
             filen = self.collectionsgf.set_filen()
         print 'filen from collectionsgf is',filen
         if mode == 'quiet':
-            self.abstractboard.save_sgf(filen)
+            if not self.needs_saving():
+                if wait:
+                    sgf_saver.wait()
+                return
+            self.abstractboard.save_sgf(filen,wait=wait)
         elif mode == 'saveas':
             self.ask_where_to_save()
         self.collectionsgf.save()
         #App.get_running_app().collections.save()
 
+    def needs_saving(self):
+        filen = self.collectionsgf.filen
+        return filen == '' or self.abstractboard.is_dirty() or not exists(filen)
+
     def ask_where_to_save(self,force=True):
         sq = SaveQuery(board=self,collectionsgf=self.collectionsgf)
         popup = Popup(content=sq,title='Where to save?',size_hint=(0.85,0.85))
@@ -733,9 +984,13 @@ class GuiBoard(Widget):
 
     def jump_to_node_by_number(self,number):
         #print 'asked to jump to node',number,'from',self.current_node_index
-        if int(number) != self.current_node_index:
+        index = self.current_node_index
+        pending = self.pending_instructions
+        if pending is not None and 'nodeindex' in pending:
+            index = pending['nodeindex'][0]
+        if int(number) != index:
             instructions = self.abstractboard.jump_to_leaf_number(number)
-            self.follow_instructions(instructions)
+            self.queue_instructions(instructions)
         else:
             pass
             #print '...but already at that node!'
@@ -889,6 +1144,7 @@ class GuiBoard(Widget):
     def set_new_comment(self,comment):
         self.comment_text = comment
         self.abstractboard.curnode.set('C',comment)
+        self.abstractboard.mark_dirty()
 
     def clear_ld_markers(self):
         for coords in self.ld_markers:
@@ -996,7 +1252,7 @@ class GuiBoard(Widget):
     def marker_colour(self, coord):
         coord = tuple(coord)
         if self.stones.has_key(coord):
-            stone_colour = self.stones[coord].colour
+            stone_colour = self.stones[coord]
             if stone_colour == 'black':
                 return [1,1,1]
             else:
@@ -1040,10 +1296,10 @@ class GuiBoard(Widget):
         self.set_playmarker
 
     def on_size(self,*args,**kwargs):
+        self.invalidate_geometry()
         self.gobanpos = self.pos
         self.gridlines = self.get_gridlines()
 
-        self.update_starpoints()
         self.update_stones()
         self.update_playmarker()
         self.update_markers()
@@ -1053,87 +1309,134 @@ class GuiBoard(Widget):
         self.on_size()
 
     def on_gobanpos(self,*args,**kwargs):
+        self.invalidate_geometry()
         self.gridlines = self.get_gridlines()
 
-        self.update_starpoints()
         self.update_stones()
         self.update_playmarker()
         self.update_markers()
 
+    def get_geometry(self):
+        geometry = self.geometry
+        if geometry is None or geometry.gridsize != self.gridsize:
+            geometry = BoardGeometry(
+                self.gridsize,
+                (self.gobanpos[0] + self.boardindent[0],
+                 self.gobanpos[1] + self.boardindent[1]),
+                self.gridspacing,
+                (self.flip_horiz, self.flip_vert,
+                 self.flip_forwardslash, self.flip_backslash),
+                self.starpoint_positions.get(self.gridsize, []))
+            self.geometry = geometry
+        return geometry
+
+    def invalidate_geometry(self,*args):
+        self.geometry = None
+
+    def flips_changed(self,*args):
+        self.invalidate_geometry()
+        if self.stone_layer is None:
+            return
+        self.stone_layer.move_stones(self.get_geometry().grid_pos)
+        self.draw_starpoints()
+        self.update_playmarker()
+        self.update_markers()
+
     def coord_to_pos(self, coord,dotransformations=True):
-        gridspacing = self.gridspacing
-        realcoord = [coord[0],coord[1]]
-        if dotransformations:
-            if self.flip_horiz:
-                realcoord[0] = self.game.size - 1 - realcoord[0]
-            if self.flip_vert:
-                realcoord[1] = self.game.size - 1 - realcoord[1]
-            if self.flip_forwardslash:
-                realcoord = realcoord[::-1]
-            if self.flip_backslash:
-                realcoord = realcoord[self.game.size - 1 - realcoord[0],self.game.size - 1 - realcoord[1]][::-1]
-
-        coord = realcoord
-        
-        coord = (coord[0]-0.5,coord[1]-0.5)
-        return (self.gobanpos[0] + self.boardindent[0] + coord[0]*gridspacing, self.gobanpos[1] + self.boardindent[1] + coord[1]*gridspacing)
+        return self.get_geometry().coord_to_pos(coord,dotransformations)
 
     def pos_to_coord(self, pos, with_offset=True):
-        gridspacing = self.gridspacing
-        relx = (pos[0] - (self.gobanpos[0] + self.boardindent[0])) / gridspacing
-        rely = (pos[1] - (self.gobanpos[1] + self.boardindent[1])) / gridspacing
         if (self.navmode != 'Score') or not with_offset:
-            relx += self.touchoffset[0]
-            rely += self.touchoffset[1]
-        realcoord = (int(round(relx)),int(round(rely)))
-        if self.flip_horiz:
-            realcoord[0] = self.game.size - 1 - realcoord[0]
-        if self.flip_vert:
-            realcoord[1] = self.game.size - 1 - realcoord[1]
-        if self.flip_forwardslash:
-            realcoord = realcoord[::-1]
-        if self.flip_backslash:
-            realcoord = realcoord[self.game.size - 1 - realcoord[0],
-                                  self.game.size - 1 - realcoord[1]][::-1]
-        return realcoord
+            offset = self.touchoffset
+        else:
+            offset = (0,0)
+        return self.get_geometry().pos_to_coord(pos,offset)
 
     def get_gridlines(self):
-        startx = self.boardindent[0] + self.gobanpos[0]
-        starty = self.boardindent[1] + self.gobanpos[1]
-        gridspacing = self.gridspacing
-        length = self.boardlength
-        gridnum = self.gridsize
-
-        gridline = []
-
-        curx = startx
-        cury = starty
-
-        dir = 1.0
-        for y in range(self.gridsize - 1):
-            curx += dir*length
-            gridline.append([curx,cury])
-            cury += gridspacing
-            gridline.append([curx,cury])
-            dir *= -1
-        dir *= -1
-        for x in range(self.gridsize - 1):
-            cury += dir*length
-            gridline.append([curx,cury])
-            curx += gridspacing
-            gridline.append([curx,cury])
-            dir *= -1
-
-        return reduce(lambda j,k: j+k, gridline)
+        return self.get_geometry().gridlines
 
         
     # Stone methods
     def follow_instructions(self,instructions,*args,**kwargs):
-        #print 'self.display_markers is',self.display_markers
-        print '### instructions are', instructions
+        '''Draws instructions now, after any still waiting for the next
+        frame.'''
+        self.queue_instructions(instructions)
+        self.flush_instructions()
+
+    def queue_instructions(self,instructions):
+        '''Merges instructions into those waiting to be drawn, and draws
+        them all on the next frame. Navigating through many positions in
+        one frame therefore draws only the last of them.'''
         if instructions is None:
             print 'No instructions.'
             return
+        self.pending_instructions = self.merge_instructions(
+            self.pending_instructions,instructions)
+        self.flush_trigger()
+
+    def merge_instructions(self,pending,instructions):
+        if pending is None:
+            pending = {'stones': {}}
+            if 'donotclear' in instructions:
+                pending['donotclear'] = True
+        stones = pending['stones']
+        for key in ('remove','empty'):
+            for stone in instructions.get(key,[]):
+                stones[stone[0]] = None
+        for stone in instructions.get('add',[]):
+            stones[stone[0]] = colourname_to_colour(stone[1])
+
+        if 'donotclear' not in instructions:
+            # Everything but the stones is redrawn from scratch
+            for key in pending.keys():
+                if key not in ('stones','nextplayer','unsaved','saved'):
+                    pending.pop(key)
+        pending.pop('playmarker',None)
+        pending.pop('comment',None)
+        for key in ('markers','varpositions'):
+            if key in instructions:
+                pending[key] = pending.get(key,[]) + list(instructions[key])
+        for key in ('playmarker','variations','comment','pre_text','nodeindex'):
+            if key in instructions:
+                pending[key] = instructions[key]
+
+        if 'nextplayer' in instructions:
+            player = instructions['nextplayer']
+            if player == 'a':
+                player = alternate_colour(pending.get('nextplayer',self.next_to_play))
+            pending['nextplayer'] = player
+        if 'unsaved' in instructions:
+            pending.pop('saved',None)
+            pending['unsaved'] = True
+        if 'saved' in instructions:
+            pending.pop('unsaved',None)
+            pending['saved'] = True
+        return pending
+
+    def flush_instructions(self,*args):
+        '''Draws the net change of the instructions waiting to be drawn.'''
+        pending = self.pending_instructions
+        if pending is None:
+            return
+        self.pending_instructions = None
+        stones = pending.pop('stones')
+        remove = []
+        add = []
+        for coord, colour in stones.iteritems():
+            current = self.stones.get(coord)
+            if current == colour:
+                continue
+            if current is not None:
+                remove.append((coord,current))
+            if colour is not None:
+                add.append((coord,colour))
+        pending['remove'] = remove
+        pending['add'] = add
+        self.draw_instructions(pending)
+
+    def draw_instructions(self,instructions):
+        #print 'self.display_markers is',self.display_markers
+        print '### instructions are', instructions
 
         t1 = time()
         
@@ -1252,7 +1555,7 @@ class GuiBoard(Widget):
         t2 = time()
         if children_exist:
             instructions = self.abstractboard.advance_position()
-            self.follow_instructions(instructions)
+            self.queue_instructions(instructions)
             if 'add' in instructions:
                 App.get_running_app().play_stone_sound()
         else:
@@ -1287,15 +1590,15 @@ class GuiBoard(Widget):
             self.make_scoreboard()
         instructions = self.abstractboard.retreat_position()
         if instructions is not None:
-            self.follow_instructions(instructions)
+            self.queue_instructions(instructions)
 
     def jump_to_start(self,*args,**kwargs):
         instructions = self.abstractboard.jump_to_node(self.abstractboard.game.root)
-        self.follow_instructions(instructions)
+        self.queue_instructions(instructions)
 
     def jump_to_end(self,*args,**kwargs):
         instructions = self.abstractboard.jump_to_node(self.abstractboard.game.get_last_node())
-        self.follow_instructions(instructions)
+        self.queue_instructions(instructions)
         
     def reset_uielements(self,*args,**kwargs):
         self.comment_pre_text = ''
@@ -1311,34 +1614,23 @@ class GuiBoard(Widget):
                     element.text = 'Next var\n  (1 / 1)'
 
     def add_variation_stone(self,coord=(1,1),colour='black',num=1,*args,**kwargs):
-        stonesize = self.stonesize
-
-        stone = self.cache.get_var_stone()
-        stone.size = stonesize
-        stone.pos = self.coord_to_pos(coord)
-        stone.text = str(num)
-        stone.set_colour(colour)
-
-        if self.varstones.has_key(coord):
-            stone = self.varstones.pop(coord)
-            self.remove_widget(stone)
-            self.cache.cache_var_stone(stone)
-        self.varstones[coord] = stone
-        self.add_widget(stone)
+        self.varstones[coord] = num
+        self.stone_layer.add_varstone(coord,colourname_to_colour(colour),num,
+                                      self.get_geometry().grid_pos(coord))
 
     def clear_variation_stones(self):
-        for coord in self.varstones.keys():
-            stone = self.varstones.pop(coord)
-            self.remove_widget(stone)
-            self.cache.cache_var_stone(stone)
+        self.varstones.clear()
+        if self.stone_layer is not None:
+            self.stone_layer.clear_varstones()
 
     def add_coordinates(self):
         self.remove_coordinates()
         stonesize = self.stonesize
+        geometry = self.get_geometry()
         for i in range(self.gridsize):
             label = Label(text=self.coordinate_letter[i],
                           size=stonesize,
-                          pos=self.coord_to_pos((i,-0.75),dotransformations=False),
+                          pos=geometry.letter_positions[i],
                           font_size=(0.4*stonesize[1],'px'),
                           color=(0,0,0,1))
             self.add_widget(label)
@@ -1346,7 +1638,7 @@ class GuiBoard(Widget):
         for j in range(self.gridsize):
             label = Label(text=self.coordinate_number[j],
                           size=stonesize,
-                          pos=self.coord_to_pos((-0.75,j),dotransformations=False),
+                          pos=geometry.number_positions[j],
                           font_size=(0.4*stonesize[1],'px'),
                           color=(0,0,0,1))
             self.add_widget(label)
@@ -1356,9 +1648,21 @@ class GuiBoard(Widget):
             self.remove_widget(widget)
         self.coordinate_labels = []
     def update_coordinates(self):
-        self.remove_coordinates()
-        if self.coordinates:
+        if not self.coordinates:
+            self.remove_coordinates()
+            return
+        labels = self.coordinate_labels
+        if len(labels) != 2*self.gridsize:
             self.add_coordinates()
+            return
+        # Moves the existing labels rather than making new ones
+        geometry = self.get_geometry()
+        stonesize = self.stonesize
+        positions = geometry.letter_positions + geometry.number_positions
+        for label, pos in zip(labels,positions):
+            label.pos = pos
+            label.size = stonesize
+            label.font_size = (0.4*stonesize[1],'px')
 
     def toggle_background_stone(self, coords, colour):
         print 'toggling background stone'
@@ -1373,118 +1677,75 @@ class GuiBoard(Widget):
         self.follow_instructions(instructions)
 
     def add_stone(self,coord=(1,1),colour='black',*args,**kwargs):
-        stonesize = self.stonesize
-        t1 = time()
-        try:
-            stone = self.cache.get_stone(colour[0])
-        except AttributeError:
-            print 'ATTRIBUTE ERROR!'
-            stone = Stone() #size=stonesize, pos=self.coord_to_pos(coord))
-            stone.set_colour(colour)
-        stone.size = stonesize
-        stone.pos = self.coord_to_pos(coord)
-        t2 = time()
         if self.stones.has_key(coord):
             self.remove_stone(coord)
-        self.stones[coord] = stone
-        t3 = time()
-        self.add_widget(stone)
-        t4 = time()
-        # print '@@ total', t4-t1
-        # print '@@ make stone', t2-t1, (t2-t1)/(t4-t1)
-        # print '@@ add to dict', t3-t2, (t3-t2)/(t4-t1)
-        # print '@@ add widget', t4-t3, (t4-t3)/(t4-t1)
+        self.stones[coord] = colour
+        self.stone_layer.add_stone(coord,colour,self.get_geometry().grid_pos(coord))
 
     def remove_stone(self,coord=(1,1),*args,**kwargs):
         #print 'asked to remove at coord',coord
         #print 'available stones are',self.stones
         if self.stones.has_key(coord):
-            stone = self.stones.pop(coord)
-            self.remove_widget(stone)
-            self.cache.cache_stone(stone,stone.colour)
+            self.stones.pop(coord)
+            self.stone_layer.remove_stone(coord)
         else:
             print 'Tried to remove stone that doesn\'t exist'
 
     def empty_stone(self,coord=(1,1),*args,**kwargs):
         if self.stones.has_key(coord):
-            stone = self.stones.pop(coord)
-            self.remove_widget(stone)
+            self.stones.pop(coord)
+            self.stone_layer.remove_stone(coord)
 
     def update_stones(self):
-        for coord in self.stones.keys():
-            self.stones[coord].pos = self.coord_to_pos(coord)
-            self.stones[coord].size = self.stonesize
+        '''Fits the stones and starpoints to the board's layout, by
+        changing the stone layer's transform.'''
+        if self.stone_layer is None:
+            return
+        geometry = self.get_geometry()
+        self.stone_layer.set_transform(geometry.origin,geometry.spacing)
 
     def replace_stones(self):
-        for coord in self.stones.keys():
-            stone = self.stones.pop(coord)
-            self.remove_widget(stone)
-            self.add_stone(coord,stone.colour)
+        self.stone_layer.stone_type = App.get_running_app().stone_type
         self.update_playmarker()
 
-    def redraw_stones(self):
-        for coord in self.stones.keys():
-            stone = self.stones[coord]
-            self.remove_widget(stone)
-            self.add_widget(stone)
-
     def clear_stones(self):
-        for coord in self.stones.keys():
-            stone = self.stones.pop(coord)
-            self.remove_widget(stone)
+        self.pending_instructions = None
+        self.stones.clear()
+        self.stone_layer.clear_stones()
 
             
 
     # Star point methods
     def draw_starpoints(self):
+        '''Draws the starpoints as ellipses under the stones, in the
+        stone layer's grid units.'''
+        if self.stone_layer is None:
+            return
         self.remove_starpoints()
-        if self.starpoint_positions.has_key(self.gridsize):
-            coords = self.starpoint_positions[self.gridsize]
-            for entry in coords:
-                self.add_starpoint(entry)
-    
-    def add_starpoint(self,coord=(1,1),*args,**kwargs):
-        stonesize = self.stonesize
-        sp = StarPoint(size=stonesize, pos=self.coord_to_pos(coord))
-        if self.starpoints.has_key(coord):
-            self.remove_starpoint(coord)
-        self.starpoints[coord] = sp
-        self.add_widget(sp)
-        self.redraw_stones()
-
-    def remove_starpoint(self,coord=(1,1),*args,**kwargs):
-        if self.starpoints.has_key(coord):
-            sp = self.starpoints.pop(coord)
-            self.remove_widget(sp)
-        else:
-            print 'Tried to remove starpoint that doesn\'t exist'
+        marks = self.stone_layer.marks
+        marks.add(Color(0,0,0))
+        for coord, gridpos in self.get_geometry().starpoints:
+            ellipse = Ellipse(pos=(gridpos[0]+0.375,gridpos[1]+0.375),size=(0.25,0.25))
+            marks.add(ellipse)
+            self.starpoints[coord] = ellipse
 
     def remove_starpoints(self):
-        for entry in self.starpoints:
-            sp = self.starpoints[entry]
-            self.remove_widget(sp)
+        if self.stone_layer is not None:
+            self.stone_layer.marks.clear()
         self.starpoints = {}
 
     def update_starpoints(self):
-        self.remove_starpoints()
         self.draw_starpoints()
 
-    def redraw_starpoints(self):
-        for coord in self.starpoints.keys():
-            sp = self.starpoints[coord]
-            self.remove_widget(ssp)
-            self.add_widget(sp)
-        self.redraw_stones()
-
     # Variation handling
     def next_variation(self,*args,**kwargs):
         print 'next variation called'
         instructions = self.abstractboard.increment_variation()
-        self.follow_instructions(instructions)
+        self.queue_instructions(instructions)
 
     def prev_variation(self,*args,**kwargs):
         instructions = self.abstractboard.decrement_variation()
-        self.follow_instructions(instructions)
+        self.queue_instructions(instructions)
 
     # Syncing
     def reset_abstractboard(self):
@@ -1535,11 +1796,11 @@ class BoardContainer(StencilView):
     def on_touch_down(self,touch):
         if self.collide_point(*touch.pos):
             self.board.stop_autoplay()
+            self.board.flush_instructions()
             if self.board.navmode == 'Navigate':
                 coord = self.board.pos_to_coord(touch.pos)
                 if coord in self.board.varstones:
-                    varstone = self.board.varstones[coord]
-                    varnum = int(varstone.text) - 1
+                    varnum = self.board.varstones[coord] - 1
                     instructions = self.board.abstractboard.jump_to_var(varnum)
                     self.board.follow_instructions(instructions)
                 else:
@@ -1682,23 +1943,21 @@ class BoardContainer(StencilView):
                 return
             if oldcoord not in self.board.stones:
                 return
-            stone = self.board.stones.pop(oldcoord)
+            colour = self.board.stones[oldcoord]
             instructions_back = self.board.abstractboard.retreat_position()
             instructions_forward = self.board.abstractboard.replace_next_node(
-                newcoord, stone.colour[0])
+                newcoord, colour[0])
 
             self.board.follow_instructions(instructions_back)
             self.board.follow_instructions(instructions_forward)
-            self.board.remove_stone(newcoord)
             # back_removes = instructions_back['remove']
             # back_adds = instructions_back['add']
             # fore_removes = instructions_forward['remove']
             # fore_add = instructions_forward['add']
             
-            self.board.stones[newcoord] = stone
+            self.board.stone_layer.slide_stone(
+                newcoord, self.board.get_geometry().grid_pos(oldcoord), 0.3)
             newpos = self.board.coord_to_pos(newcoord)
-            anim = Animation(pos=newpos, t='in_out_sine', duration=0.3)
-            anim.start(stone)
             if self.board.playmarker is not None:
                 anim = Animation(pos=newpos, t='in_out_sine', duration=0.3)
                 anim.start(self.board.playmarker)
@@ -1825,10 +2084,13 @@ class SaveQuery(BoxLayout):
     board = ObjectProperty(None,allownone=True)
     collectionsgf = ObjectProperty(None,allownone=True)
 
+class PositionSearchResults(BoxLayout):
+    results_list = ObjectProperty(None,allownone=True)
+    board = ObjectProperty(None,allownone=True)
+    popup = ObjectProperty(None,allownone=True)
+
 def get_collectioninfo_from_dir(row_index,dirn):
     sgfs = glob(dirn + '/*.sgf')
     colname = dirn.split('/')[-1]
     return {'colname': colname, 'coldir': dirn, 'numentries': len(sgfs)}
 
-class MySpinnerOption(SpinnerOption):
-    pass
@@ -11,6 +11,12 @@
 from kivy.app import App
 from kivy.core.window import Window
 from kivy.uix.widget import Widget
+from kivy.graphics import Color, Ellipse, Rectangle, InstructionGroup, PushMatrix, PopMatrix, Translate, Scale, Fbo, ClearColor, ClearBuffers, Callback
+from kivy.graphics.opengl import glBlendFunc, GL_ONE, GL_ZERO, GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA
+from kivy.core.image import Image as CoreImage
+from kivy.core.text import Label as CoreLabel
+from kivy.animation import AnimationTransition
+from kivy.clock import Clock
 from kivy.properties import NumericProperty, ReferenceListProperty, ObjectProperty, ListProperty, AliasProperty, StringProperty, DictProperty, BooleanProperty, StringProperty, OptionProperty
 
 def get_stone_image_location(colour):
@@ -70,6 +76,305 @@ class BlackStoneSimple(Widget):
     stone_image = StringProperty('./media/stones/black_shell_100.png')
 
 from random import choice
+
+# The images drawn for each stone_type, as in the stone widget kv rules.
+# Stone types without images are drawn as plain ellipses.
+stone_images = {
+    'slate and shell': {'black': ['./media/stones/black_shell_100_2.png'],
+                        'white': ['./media/stones/white_shell_100.png',
+                                  './media/stones/white_shell_100_2.png',
+                                  './media/stones/white_shell_100_3.png',
+                                  './media/stones/white_shell_100_4.png',
+                                  './media/stones/white_shell_100_5.png']},
+    'bordered slate and shell': {
+        'black': ['./media/stones/black_borderedshell_100.png'],
+        'white': ['./media/stones/white_borderedshell_100_2.png']},
+    'stylised': {'black': ['./media/stones/black_stylised_100.png'],
+                 'white': ['./media/stones/white_stylised_100.png']},
+    'simple': {'black': ['./media/stones/black_simple_100.png'],
+               'white': ['./media/stones/white_simple_100.png']},
+    }
+
+stone_textures = {}
+def get_stone_texture(source):
+    if not stone_textures.has_key(source):
+        stone_textures[source] = CoreImage(source).texture
+    return stone_textures[source]
+
+# Variation stone colours, as VarStone.set_colour. The disc is drawn
+# opaque into the atlas, and its alpha applied when it is drawn.
+varstone_colours = {'black': ((0, 0, 0, 0.2), (1, 1, 1, 0.6)),
+                    'white': ((1, 1, 1, 0.2), (0, 0, 0, 0.6))}
+
+def get_atlas_cell(stone_pixels):
+    '''Returns the atlas cell size in pixels for stones drawn
+    stone_pixels wide: the next power of two, from 32 up to 128, as the
+    stone images are 100 pixels.'''
+    cell = 32
+    while cell < stone_pixels and cell < 128:
+        cell *= 2
+    return cell
+
+def set_copy_blend(*args):
+    glBlendFunc(GL_ONE, GL_ZERO)
+
+def set_default_blend(*args):
+    glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+
+class StoneAtlas(object):
+    '''One texture holding every stone of a stone_type, and the
+    variation stone discs, each drawn once into a cell of an Fbo.
+    Stones are then single textured quads using a region of it.
+    Variation numbers are rendered on first use and kept.'''
+    def __init__(self, stone_type, cell):
+        self.stone_type = stone_type
+        self.cell = cell
+        self.numbers = {}
+        cells = []
+        for colour in ('black', 'white'):
+            images = stone_images.get(stone_type, {}).get(colour)
+            if images:
+                for source in images:
+                    cells.append(((colour, source), self.draw_image, source))
+            else:
+                cells.append(((colour, 'drawn'), self.draw_drawn_stone, colour))
+        for colour in ('black', 'white'):
+            cells.append((('var', colour), self.draw_varstone, colour))
+
+        self.cells = cells
+        self.fbo = Fbo(size=(cell*len(cells), cell))
+        # The Fbo is in no canvas, so is drawn again by hand when the GL
+        # context is lost, e.g. on resuming on Android
+        self.fbo.add_reload_observer(self.draw_cells)
+        self.draw_cells(self.fbo)
+        texture = self.fbo.texture
+        self.regions = {}
+        self.stones = {'black': [], 'white': []}
+        for i, (name, draw, arg) in enumerate(cells):
+            region = texture.get_region(i*cell, 0, cell, cell)
+            self.regions[name] = region
+            if name[0] != 'var':
+                self.stones[name[0]].append(region)
+    def __str__(self):
+        return 'StoneAtlas for {0} at {1}px, {2} cells'.format(
+            self.stone_type, self.cell, len(self.regions))
+    def __repr__(self):
+        return self.__str__()
+
+    def draw_cells(self, fbo):
+        fbo.clear()
+        with fbo:
+            ClearColor(0, 0, 0, 0)
+            ClearBuffers()
+            # Cells are copied in rather than blended, as blending onto
+            # the transparent Fbo would store each alpha squared
+            Callback(set_copy_blend)
+            for i, (name, draw, arg) in enumerate(self.cells):
+                draw(arg, i*self.cell)
+            Callback(set_default_blend)
+        fbo.draw()
+
+    def draw_image(self, source, x):
+        Color(1, 1, 1, 1)
+        Rectangle(texture=get_stone_texture(source), pos=(x, 0),
+                  size=(self.cell, self.cell))
+    def draw_drawn_stone(self, colour, x):
+        cell = self.cell
+        Color(0, 0, 0, 1)
+        Ellipse(pos=(x, 0), size=(cell, cell))
+        if colour == 'white':
+            Color(1, 1, 1, 1)
+        Ellipse(pos=(x + 0.05*cell, 0.05*cell), size=(0.9*cell, 0.9*cell))
+    def draw_varstone(self, colour, x):
+        cell = self.cell
+        Color(*varstone_colours[colour][0][:3])
+        Ellipse(pos=(x + 0.05*cell, 0.05*cell), size=(0.9*cell, 0.9*cell))
+
+    def get_stone(self, colour):
+        '''Returns a texture region for a stone, picking one of the
+        style's images at random if it has several.'''
+        return choice(self.stones[colour])
+    def get_varstone(self, colour):
+        return self.regions[('var', colour)]
+    def get_number(self, number):
+        '''Returns a white texture of number, sized for the cell.'''
+        if not self.numbers.has_key(number):
+            label = CoreLabel(text=str(number), font_size=int(0.45*self.cell))
+            label.refresh()
+            self.numbers[number] = label.texture
+        return self.numbers[number]
+
+stone_atlases = {}
+def get_stone_atlas(stone_type, stone_pixels):
+    '''Returns the StoneAtlas for a stone_type and stone size, making
+    it if needed. Atlases of other stone types are dropped.'''
+    cell = get_atlas_cell(stone_pixels)
+    for key in stone_atlases.keys():
+        if key[0] != stone_type:
+            stone_atlases.pop(key)
+    if not stone_atlases.has_key((stone_type, cell)):
+        stone_atlases[(stone_type, cell)] = StoneAtlas(stone_type, cell)
+    return stone_atlases[(stone_type, cell)]
+
+def make_stone_instructions(colour, atlas):
+    '''Returns an InstructionGroup drawing one stone one grid unit
+    wide, and the Rectangle to move it by.'''
+    group = InstructionGroup()
+    group.add(Color(1, 1, 1, 1))
+    shape = Rectangle(texture=atlas.get_stone(colour), size=(1, 1))
+    group.add(shape)
+    return group, shape
+
+class StoneLayer(Widget):
+    '''Draws every stone of a board as canvas instructions in one
+    group, so that adding or removing a stone edits the instruction
+    list instead of adding or removing a widget.
+
+    Stones are placed in grid units, a stone being 1 wide, and a single
+    translate and scale maps them onto the board, so resizing the board
+    only changes those two instructions. The marks group is drawn
+    under the stones in the same units, for starpoints, and variation
+    stones are drawn over them.
+
+    Stones and variation stones are regions of the StoneAtlas for the
+    stone_type and current stone size.'''
+    stone_type = StringProperty('simple')
+    def __init__(self, *args, **kwargs):
+        self.stones = {} # coord -> [colour, group, shape, gridpos]
+        self.varstones = {} # coord -> (colour, number, gridpos, group)
+        self.slides = {}
+        self.stone_pixels = 32
+        self.atlas = None
+        super(StoneLayer, self).__init__(*args, **kwargs)
+        self.atlas = get_stone_atlas(self.stone_type, self.stone_pixels)
+        self.translate = Translate(0, 0)
+        self.scale = Scale(1)
+        self.marks = InstructionGroup()
+        self.group = InstructionGroup()
+        self.vargroup = InstructionGroup()
+        self.canvas.add(PushMatrix())
+        self.canvas.add(self.translate)
+        self.canvas.add(self.scale)
+        self.canvas.add(self.marks)
+        self.canvas.add(self.group)
+        self.canvas.add(self.vargroup)
+        self.canvas.add(PopMatrix())
+
+    def set_transform(self, origin, spacing):
+        '''Maps grid units onto the board, with grid position (0, 0) at
+        origin. The stones are redrawn from a new atlas only if spacing
+        needs a different atlas cell size.'''
+        self.translate.xy = origin
+        self.scale.scale = spacing
+        self.stone_pixels = spacing
+        if self.atlas.cell != get_atlas_cell(spacing):
+            self.restyle()
+
+    def add_stone(self, coord, colour, gridpos):
+        if self.stones.has_key(coord):
+            self.remove_stone(coord)
+        group, shape = make_stone_instructions(colour, self.atlas)
+        shape.pos = gridpos
+        self.group.add(group)
+        self.stones[coord] = [colour, group, shape, gridpos]
+
+    def remove_stone(self, coord):
+        if self.stones.has_key(coord):
+            self.stop_slide(coord)
+            colour, group, shape, gridpos = self.stones.pop(coord)
+            self.group.remove(group)
+
+    def clear_stones(self):
+        for coord in self.slides.keys():
+            self.stop_slide(coord)
+        self.group.clear()
+        self.stones = {}
+
+    def move_stones(self, get_gridpos):
+        '''Moves every stone and variation stone to get_gridpos(coord),
+        for when the board is flipped.'''
+        for coord in self.slides.keys():
+            self.stop_slide(coord)
+        for coord, stone in self.stones.iteritems():
+            stone[3] = get_gridpos(coord)
+            stone[2].pos = stone[3]
+        varstones = self.varstones
+        self.clear_varstones()
+        for coord, (colour, number, gridpos, group) in varstones.iteritems():
+            self.add_varstone(coord, colour, number, get_gridpos(coord))
+
+    def add_varstone(self, coord, colour, number, gridpos):
+        '''Draws a variation stone, numbered, over any stone at coord.'''
+        self.remove_varstone(coord)
+        atlas = self.atlas
+        group = InstructionGroup()
+        group.add(Color(1, 1, 1, varstone_colours[colour][0][3]))
+        group.add(Rectangle(texture=atlas.get_varstone(colour), pos=gridpos,
+                            size=(1, 1)))
+        texture = atlas.get_number(number)
+        width = float(texture.width) / atlas.cell
+        height = float(texture.height) / atlas.cell
+        group.add(Color(*varstone_colours[colour][1]))
+        group.add(Rectangle(texture=texture,
+                            pos=(gridpos[0] + 0.5 - 0.5*width,
+                                 gridpos[1] + 0.5 - 0.5*height),
+                            size=(width, height)))
+        self.vargroup.add(group)
+        self.varstones[coord] = (colour, number, gridpos, group)
+
+    def remove_varstone(self, coord):
+        if self.varstones.has_key(coord):
+            self.vargroup.remove(self.varstones.pop(coord)[3])
+
+    def clear_varstones(self):
+        self.vargroup.clear()
+        self.varstones = {}
+
+    def on_stone_type(self, *args):
+        if self.atlas is not None:
+            self.restyle()
+
+    def restyle(self):
+        '''Rebuilds every stone's instructions from the atlas for the
+        current stone_type and size.'''
+        self.atlas = get_stone_atlas(self.stone_type, self.stone_pixels)
+        stones = self.stones
+        self.clear_stones()
+        for coord, (colour, group, shape, gridpos) in stones.iteritems():
+            self.add_stone(coord, colour, gridpos)
+        varstones = self.varstones
+        self.clear_varstones()
+        for coord, (colour, number, gridpos, group) in varstones.iteritems():
+            self.add_varstone(coord, colour, number, gridpos)
+
+    def slide_stone(self, coord, from_gridpos, duration=0.3):
+        '''Animates the stone at coord from from_gridpos to where it
+        is.'''
+        if not self.stones.has_key(coord):
+            return
+        self.stop_slide(coord)
+        colour, group, shape, gridpos = self.stones[coord]
+        transition = AnimationTransition.in_out_sine
+        state = {'time': 0.}
+        def step(dt):
+            state['time'] += dt
+            progress = min(1., state['time'] / duration)
+            fraction = transition(progress)
+            shape.pos = (from_gridpos[0] + fraction*(gridpos[0]-from_gridpos[0]),
+                         from_gridpos[1] + fraction*(gridpos[1]-from_gridpos[1]))
+            if progress >= 1.:
+                self.stop_slide(coord)
+        shape.pos = from_gridpos
+        self.slides[coord] = step
+        Clock.schedule_interval(step, 0)
+
+    def stop_slide(self, coord):
+        step = self.slides.pop(coord, None)
+        if step is not None:
+            Clock.unschedule(step)
+            colour, group, shape, gridpos = self.stones[coord]
+            shape.pos = gridpos
+
 class WhiteStoneShell(Widget):
     colour = StringProperty('white')
     stone_image = StringProperty('./media/stones/white_shell_100.png')
@@ -1,8 +1,35 @@
 """Go board representation."""
 
+import random
+
 from gomill.common import *
 
 
+_zobrist_tables = {}
+
+def get_zobrist_table(side):
+    """Return the Zobrist keys for a board size.
+
+    Returns a dict mapping colour ('b' or 'w') to a side x side list of
+    lists of 64-bit integers, indexed [row][col].
+
+    The keys are generated from a fixed seed, so hashes are stable between
+    runs and can be stored.
+
+    """
+    try:
+        return _zobrist_tables[side]
+    except KeyError:
+        pass
+    rng = random.Random(0x9e3779b9 + side)
+    table = {}
+    for colour in ('b', 'w'):
+        table[colour] = [[rng.getrandbits(64) for _col in range(side)]
+                         for _row in range(side)]
+    _zobrist_tables[side] = table
+    return table
+
+
 class _Group(object):
     """Represent a solidly-connected group.
 
@@ -40,6 +67,10 @@ class Board(object):
 
     Behaviour is unspecified if methods are passed out-of-range coordinates.
 
+    The position's Zobrist hash is maintained incrementally by play(),
+    apply_setup() and set(). If you modify the board attribute directly,
+    call recalculate_hash() afterwards.
+
     """
     def __init__(self, side):
         self.side = side
@@ -49,14 +80,36 @@ class Board(object):
         for row in range(side):
             self.board.append([None] * side)
         self._is_empty = True
+        self._zobrist = get_zobrist_table(side)
+        self._hash = 0
 
     def copy(self):
         """Return an independent copy of this Board."""
         b = Board(self.side)
         b.board = [self.board[i][:] for i in xrange(self.side)]
         b._is_empty = self._is_empty
+        b._hash = self._hash
         return b
 
+    def zobrist_hash(self):
+        """Return the Zobrist hash of the position, as a 64-bit integer.
+
+        Equal positions on boards of the same size have equal hashes. The
+        empty board hashes to 0.
+
+        """
+        return self._hash
+
+    def recalculate_hash(self):
+        """Recompute the Zobrist hash from scratch."""
+        zobrist = self._zobrist
+        h = 0
+        for (row, col) in self.board_points:
+            colour = self.board[row][col]
+            if colour is not None:
+                h ^= zobrist[colour][row][col]
+        self._hash = h
+
     def _make_group(self, row, col, colour):
         points = set()
         is_surrounded = True
@@ -127,6 +180,32 @@ class Board(object):
             handled.update(group.points)
         return surrounded
 
+    def _find_surrounded_groups_near(self, row, col):
+        """Find solidly-connected groups with 0 liberties touching a point.
+
+        Considers the group containing (row, col) and the groups on the
+        orthogonally adjacent points.
+
+        Returns a list of _Groups.
+
+        """
+        surrounded = []
+        handled = set()
+        for (r, c) in [(row, col),
+                       (row-1, col), (row+1, col), (row, col-1), (row, col+1)]:
+            if not ((0 <= r < self.side) and (0 <= c < self.side)):
+                continue
+            colour = self.board[r][c]
+            if colour is None:
+                continue
+            if (r, c) in handled:
+                continue
+            group = self._make_group(r, c, colour)
+            if group.is_surrounded:
+                surrounded.append(group)
+            handled.update(group.points)
+        return surrounded
+
     def is_empty(self):
         """Say whether the board is empty."""
         return self._is_empty
@@ -139,6 +218,24 @@ class Board(object):
         """
         return self.board[row][col]
 
+    def set(self, row, col, colour):
+        """Set the state of the specified point directly.
+
+        colour -- 'b', 'w', or None for an empty point
+
+        Performs no captures.
+
+        """
+        old_colour = self.board[row][col]
+        if old_colour == colour:
+            return
+        if old_colour is not None:
+            self._hash ^= self._zobrist[old_colour][row][col]
+        if colour is not None:
+            self._hash ^= self._zobrist[colour][row][col]
+            self._is_empty = False
+        self.board[row][col] = colour
+
     def play(self, row, col, colour):
         """Play a move on the board.
 
@@ -149,13 +246,32 @@ class Board(object):
 
         Returns the point forbidden by simple ko, or None
 
+        """
+        return self.play_with_captures(row, col, colour)[0]
+
+    def play_with_captures(self, row, col, colour):
+        """Play a move on the board, reporting the stones it removed.
+
+        Behaves exactly as play(), but returns a pair
+          (simple_ko_point, captured)
+
+        simple_ko_point -- the point forbidden by simple ko, or None
+        captured        -- list of pairs (colour, (row, col)) for every stone
+                           removed by the move (including self-captures)
+
+        Only the groups touching the new stone are examined, so the cost
+        doesn't depend on the number of stones elsewhere on the board.
+
         """
         if self.board[row][col] is not None:
             raise ValueError
         self.board[row][col] = colour
         self._is_empty = False
-        surrounded = self._find_surrounded_groups()
+        zobrist = self._zobrist
+        self._hash ^= zobrist[colour][row][col]
+        surrounded = self._find_surrounded_groups_near(row, col)
         simple_ko_point = None
+        captured = []
         if surrounded:
             if len(surrounded) == 1:
                 to_capture = surrounded
@@ -170,9 +286,12 @@ class Board(object):
                     if len(self_capture[0].points) == 1:
                         simple_ko_point = iter(to_capture[0].points).next()
             for group in to_capture:
+                group_keys = zobrist[group.colour]
                 for r, c in group.points:
                     self.board[r][c] = None
-        return simple_ko_point
+                    self._hash ^= group_keys[r][c]
+                    captured.append((group.colour, (r, c)))
+        return simple_ko_point, captured
 
     def apply_setup(self, black_points, white_points, empty_points):
         """Add setup stones or removals to the position.
@@ -191,15 +310,15 @@ class Board(object):
 
         """
         for (row, col) in black_points:
-            self.board[row][col] = 'b'
+            self.set(row, col, 'b')
         for (row, col) in white_points:
-            self.board[row][col] = 'w'
+            self.set(row, col, 'w')
         for (row, col) in empty_points:
-            self.board[row][col] = None
+            self.set(row, col, None)
         captured = self._find_surrounded_groups()
         for group in captured:
             for row, col in group.points:
-                self.board[row][col] = None
+                self.set(row, col, None)
         self._is_empty = True
         for (row, col) in self.board_points:
             if self.board[row][col] is not None:
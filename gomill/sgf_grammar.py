@@ -112,6 +112,68 @@ def tokenise(s, start_position=0):
                     break
     return result, i
 
+def read_sgf_root(f, chunk_size=4096):
+    """Read the root node of the first SGF game in a file.
+
+    f          -- file-like object returning 8-bit strings
+    chunk_size -- number of bytes to read at a time
+
+    Returns a property map.
+
+    Reads from 'f' in chunks, and stops tokenising at the end of the first
+    node, so the cost doesn't depend on the length of the game.
+
+    Raises ValueError if no SGF data is found, or if the root node can't be
+    parsed. Data missing after the root node (for example in a truncated
+    file) isn't treated as an error.
+
+    Identifies the start of the SGF content in the same way as
+    parse_sgf_game().
+
+    """
+    s = ""
+    i = None
+    at_eof = False
+    properties = {}
+    prop_ident = None
+    prop_values = None
+    while not at_eof:
+        chunk = f.read(chunk_size)
+        at_eof = not chunk
+        s += chunk
+        if i is None:
+            m = _find_start_re.search(s)
+            if not m:
+                continue
+            i = m.end()
+        while True:
+            m = _tokenise_re.match(s, i)
+            if not m:
+                break
+            # A PropIdent at the end of the data may continue in the next
+            # chunk
+            if m.end() == len(s) and not at_eof:
+                break
+            i = m.end()
+            token_type = m.lastgroup
+            token = m.group(m.lastindex)
+            if token_type == 'V':
+                if prop_values is None:
+                    raise ValueError("unexpected value")
+                prop_values.append(token)
+                continue
+            if prop_values is not None and not prop_values:
+                raise ValueError("property with no values")
+            if token_type == 'D':
+                return properties
+            prop_ident = token
+            prop_values = properties.setdefault(prop_ident, [])
+    if i is None:
+        raise ValueError("no SGF data found")
+    if prop_values is not None and not prop_values:
+        raise ValueError("property with no values")
+    return properties
+
 class Coarse_game_tree(object):
     """An SGF GameTree.
 
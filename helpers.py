@@ -1,5 +1,19 @@
+import os
 
 def embolden(s):
     if s[:3] != '[b]':
         s = '[b]' + s + '[/b]'
     return s
+
+def write_atomically(filen,data):
+    '''Writes data to a temporary file and renames it over filen, so
+    that filen is never left partly written.'''
+    tempfilen = filen + '.tmp'
+    with open(tempfilen,'w') as fileh:
+        fileh.write(data)
+        fileh.flush()
+        os.fsync(fileh.fileno())
+    # Windows can't rename over an existing file
+    if os.name == 'nt' and os.path.exists(filen):
+        os.remove(filen)
+    os.rename(tempfilen,filen)
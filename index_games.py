@@ -1,21 +1,104 @@
+'''
+Builds the bundled game collections from the sgf files in ./games/.
+
+Only the root node of each sgf is read, files are read across a process
+pool, and each collection's single store file is written once at the
+end. Sgf mtimes and sizes are stored in ./collections/index_stamps.json,
+so that a rerun only reads files that have changed.
+
+Usage: python index_games.py [processes]
+
+'''
+
 import os
+import sys
 import glob
+import json
+from multiprocessing import Pool, cpu_count
 
 from sgfcollections import Collection, CollectionSgf, CollectionsList
 from abstractboard import get_gameinfo_from_file
 
 default_cols = ['Pro10','IMeijin','Kisei','ITengen','Gosei','Honinbo','Shusaku','Meijin','CJSuperGo','Tengen','Judan','Oza','NihonKiin','Ing']
 
-collectionslist = CollectionsList()
-
-for entry in default_cols:
-    collection = Collection(name=entry,defaultdir='./games/' + entry)
-    sgfs = glob.glob('./games/' + entry + '/*.sgf')
-    for sgf in sgfs:
-        info = get_gameinfo_from_file(sgf)
-        game = collection.add_game(False)
-        game.filen = sgf
-        game.gameinfo = info
-        game.save()
-    collectionslist.collections.append(collection)
+stamps_filen = './collections/index_stamps.json'
+
+def get_stamp(filen):
+    stat = os.stat(filen)
+    return [stat.st_mtime, stat.st_size]
+
+def index_file(filen):
+    '''Returns (filen, stamp, info) for an sgf file. Runs in the pool's
+    worker processes.'''
+    return filen, get_stamp(filen), get_gameinfo_from_file(filen)
+
+def load_stamps():
+    try:
+        with open(stamps_filen, 'r') as fileh:
+            return json.load(fileh)
+    except (IOError, ValueError):
+        return {}
+
+def save_stamps(stamps):
+    with open(stamps_filen, 'w') as fileh:
+        json.dump(stamps, fileh)
+
+def load_previous_infos(collection):
+    '''Returns the game info from the last run by sgf filename.'''
+    try:
+        previous = Collection().from_file(collection.get_filen())
+    except (IOError, ValueError):
+        return {}
+    if not previous.finished_loading:
+        # An old format collection, so every game is reread
+        return {}
+    return dict([(game.filen, game.gameinfo) for game in previous.games])
+
+def index_collection(name, stamps, pool=None):
+    '''Builds and saves the collection of the sgfs in ./games/name,
+    rereading only the files whose stamps changed.'''
+    collection = Collection(name=name, defaultdir='./games/' + name)
+    infos = load_previous_infos(collection)
+    sgfs = sorted(glob.glob('./games/' + name + '/*.sgf'))
+    changed = [filen for filen in sgfs
+               if stamps.get(filen) != get_stamp(filen)
+               or not infos.has_key(filen)]
+    print name, ':', len(sgfs), 'games,', len(changed), 'changed'
+
+    if pool is not None:
+        results = pool.map(index_file, changed, chunksize=16)
+    else:
+        results = map(index_file, changed)
+    for filen, stamp, info in results:
+        infos[filen] = info
+        stamps[filen] = stamp
+
+    for filen in sgfs:
+        game = CollectionSgf(collection=collection, can_change_name=False, filen=filen)
+        game.gameinfo = infos[filen]
+        collection.games.append(game)
+    collection.save()
+    return collection
+
+def index_all(names=default_cols, processes=None):
+    stamps = load_stamps()
+    if processes is None:
+        processes = cpu_count()
+    pool = Pool(processes) if processes > 1 else None
+    collectionslist = CollectionsList()
+    try:
+        for name in names:
+            collectionslist.collections.append(index_collection(name, stamps, pool))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        save_stamps(stamps)
     collectionslist.save('indexed_collections.json')
+    return collectionslist
+
+if __name__ == '__main__':
+    processes = None
+    if len(sys.argv) > 1:
+        processes = int(sys.argv[1])
+    print index_all(processes=processes)
@@ -15,6 +15,22 @@
 # print 'THIS DIR'
 # print os.listdir('.')
 
+from time import time
+startup_start = time()
+startup_times = []
+
+def record_startup_phase(name,start):
+    '''Records the time since start for the startup report, and returns
+    the current time to start the next phase.'''
+    now = time()
+    startup_times.append((name,now-start))
+    return now
+
+def print_startup_report():
+    print 'STARTUP TIMES'
+    for name, duration in startup_times:
+        print '    {0:<30} {1:.3f}s'.format(name,duration)
+    print '    {0:<30} {1:.3f}s'.format('total',time()-startup_start)
 
 from kivy.app import App
 from kivy.core.window import Window
@@ -41,7 +57,7 @@ from kivy.uix.settings import Settings, SettingsWithSpinner, SettingsWithTabbedP
 from kivy.uix.settings import Settings
 from kivy.adapters.listadapter import ListAdapter
 #from kivy.uix.listview import ListView, ListItemButton
-from mylistview import ListView, ListItemButton
+from mylistview import ListView, ListItemButton, ListModel, ModelListAdapter
 from kivy.utils import platform
 from kivy.animation import Animation
 from kivy.properties import NumericProperty, ReferenceListProperty, ObjectProperty, ListProperty, AliasProperty, StringProperty, DictProperty, BooleanProperty, StringProperty, OptionProperty
@@ -64,15 +80,16 @@ from json import dump as jsondump, load as jsonload, dump as jsondump
 import json
 from time import asctime, time, sleep
 
-from gomill import sgf, boards
-from abstractboard import *
-from boardview import GuiBoard, BoardContainer, PhoneBoardView, TabletBoardView, GuessPopup, SaveQuery, MySpinnerOption, ReversibleSpinner
-from boardwidgets import Stone, TextMarker, TriangleMarker, SquareMarker, CircleMarker, CrossMarker, VarStone
-from miscwidgets import VDividerLine, DividerLine, WhiteStoneImage, BlackStoneImage, CarouselRightArrow, CarouselLeftArrow, AndroidTextInput
+phase_start = record_startup_phase('kivy imports',startup_start)
+
+# The board, sgf and board widget modules are imported by
+# GobanApp.import_board_modules when the first board is opened
+from miscwidgets import VDividerLine, DividerLine, WhiteStoneImage, BlackStoneImage, CarouselRightArrow, CarouselLeftArrow, AndroidTextInput, MySpinnerOption
 from info import InfoPage
 from homepage import TabletHomeScreen, HomeScreen, OpenSgfDialog
-from sgfcollections import DeleteCollectionQuestion, CollectionNameChooser, StandaloneGameChooser, GameChooserInfo, get_collectioninfo_from_dir, OpenChooserButton, CollectionsIndex, CollectionChooserButton, GameChooserButton, DeleteSgfQuestion, CollectionsList, Collection, CollectionSgf, get_collectioninfo_from_collection
-from widgetcache import WidgetCache
+from sgfcollections import DeleteCollectionQuestion, CollectionNameChooser, StandaloneGameChooser, GameChooserInfo, get_collectioninfo_from_dir, OpenChooserButton, CollectionsIndex, CollectionChooserButton, GameChooserButton, DeleteSgfQuestion, CollectionsList, Collection, CollectionSgf, get_collectioninfo_from_collection, GameSearch, CollectionView
+
+imports_end = record_startup_phase('noGo imports',phase_start)
 
 
 if platform() == 'android':
@@ -275,6 +292,7 @@ class NogoManager(ScreenManager):
     collectionindex_to_refresh = BooleanProperty(False)
     homescreen_to_refresh = BooleanProperty(False)
     collections_to_refresh = ListProperty([])
+    open_games = ObjectProperty(None,allownone=True)
 
     def open_from_intentpath(self,path):
         print 'asked to open_from_intentpath',path
@@ -385,21 +403,18 @@ class NogoManager(ScreenManager):
             matching_collections = filter(lambda j: j.name == collection_name,collections.collections)
             if len(matching_collections) > 0:
                 collection = matching_collections[0]
-                collection.finish_lazy_loading()
+                collection.load_in_background()
                 print 'Established opening',collection
                 screenname = 'Collection ' + collection.name
-                games = collection.games
+                view = CollectionView(collection=collection)
                 args_converter = lambda k,j: j.info_for_button()
-                #print 'made args converter',games
-                if len(games)>0:
-                    print args_converter('yay',games[0])
-                list_adapter = ListAdapter(data=games,
-                                           args_converter = args_converter,
-                                           selection_mode = 'single',
-                                           allow_empty_selection=True,
-                                           cls=GameChooserButton,
-                                           )
-                gc = StandaloneGameChooser(managedby=self,collection=collection)
+                list_adapter = ModelListAdapter(model=view.model,
+                                                args_converter = args_converter,
+                                                selection_mode = 'single',
+                                                allow_empty_selection=True,
+                                                cls=GameChooserButton,
+                                                )
+                gc = StandaloneGameChooser(managedby=self,collection=collection,view=view)
                 gc.gameslist.adapter = list_adapter
                 print 'made gc and set adapter'
                 #print 'games are',games
@@ -410,15 +425,28 @@ class NogoManager(ScreenManager):
                 if goto:
                     self.switch_and_set_back(s.name)
     def refresh_open_games(self):
+        '''Brings the home screen's list of open boards up to date. Boards
+        opened or closed are inserted or removed, and the rest are redrawn
+        as their game info may have changed.'''
         homepage = self.get_screen('Home')
-        args_converter = lambda c,j: get_game_chooser_info_from_boardname(self,j)
-        list_adapter = ListAdapter(data=self.boards,
-                                   args_converter=args_converter,
-                                   selection_mode='single',
-                                   allow_empty_selection=True,
-                                   cls=OpenChooserButton,
-                                   )
-        homepage.children[0].opengames.adapter = list_adapter
+        opengames = homepage.children[0].opengames
+        if self.open_games is None:
+            self.open_games = ListModel()
+        adapter = opengames.adapter
+        # A rebuilt home screen has a new ListView, which can't reuse the
+        # old adapter's views
+        if not isinstance(adapter,ModelListAdapter) or adapter.model is not self.open_games:
+            args_converter = lambda c,j: get_game_chooser_info_from_boardname(self,j)
+            opengames.adapter = ModelListAdapter(model=self.open_games,
+                                                 args_converter=args_converter,
+                                                 selection_mode='single',
+                                                 allow_empty_selection=True,
+                                                 cls=OpenChooserButton,
+                                                 )
+            self.open_games.reset(self.boards)
+            return
+        self.open_games.set_rows(self.boards)
+        self.open_games.update_rows(0,len(self.open_games))
 
     def refresh_collection(self,collection):
         print 'Asked to refresh collection',collection,collection.name
@@ -426,16 +454,7 @@ class NogoManager(ScreenManager):
         if len(matching_screens) > 0:
             scr = self.get_screen(matching_screens[0])
             gc = scr.children[0]
-            games = collection.games
-            args_converter = lambda k,j: j.info_for_button()
-            #args_converter = testconverter
-            list_adapter = ListAdapter(data=games,
-                                       args_converter = args_converter,
-                                       selection_mode = 'single',
-                                       allow_empty_selection=True,
-                                       cls=GameChooserButton,
-                                       )
-            gc.gameslist.adapter = list_adapter
+            gc.view.refresh()
         self.refresh_collections_index()
     def open_sgf_dialog(self):
         popup = Popup(content=OpenSgfDialog(manager=self),title='Open SGF',size_hint=(0.85,0.85))
@@ -447,6 +466,34 @@ class NogoManager(ScreenManager):
             collection = button.collection
             collectionsgf = button.collectionsgf
             self.new_board(with_collectionsgf=collectionsgf,mode='Navigate')
+    def board_from_position_search(self,selection):
+        if len(selection) > 0:
+            button = selection[0]
+            pbv = self.new_board(with_collectionsgf=button.collectionsgf,mode='Navigate')
+            if pbv:
+                pbv.board.jump_to_node_by_number(button.movenumber)
+    def open_game_search(self):
+        '''Opens a popup for searching every collection by game info, and
+        comments if the setting is on.'''
+        from searchindex import search_index
+        app = App.get_running_app()
+        app.build_collections_list()
+        with_comments = app.config.getdefault('Collections','search_comments','0') in ['1','True']
+        if not search_index.built or search_index.with_comments != with_comments:
+            t1 = time()
+            search_index.build(app.collections.collections,with_comments)
+            print 'built',search_index,'in',time()-t1
+        gs = GameSearch()
+        popup = Popup(content=gs,title='Search games',size_hint=(0.95,0.85),pos_hint={'top':0.95})
+        gs.popup = popup
+        list_adapter = ModelListAdapter(model=gs.results,
+                                        args_converter = lambda k,j: j.info_for_button(),
+                                        selection_mode = 'single',
+                                        allow_empty_selection=True,
+                                        cls=GameChooserButton,
+                                        )
+        gs.results_list.adapter = list_adapter
+        popup.open()
     def close_board_from_selection(self,sel):
         print 'asked to close from sel',sel
         if len(sel) > 0:
@@ -456,6 +503,7 @@ class NogoManager(ScreenManager):
             pbvs = self.get_screen(name)
             try:
                 pbvs.children[0].board.save_sgf()
+                pbvs.children[0].board.abstractboard.clear_boards()
             except IndexError:
                 pass # Board not initialised
             self.remove_widget(pbvs)
@@ -551,10 +599,11 @@ class NogoManager(ScreenManager):
         t4 = time()
 
 
+        boardview = App.get_running_app().import_board_modules()
         if self.view_mode == 'tablet':
-            pbv = TabletBoardView(collectionsgf=collectionsgf)
+            pbv = boardview.TabletBoardView(collectionsgf=collectionsgf)
         else:
-            pbv = PhoneBoardView(collectionsgf=collectionsgf)
+            pbv = boardview.PhoneBoardView(collectionsgf=collectionsgf)
         pbv.board.collectionsgf = collectionsgf
 
         # if platform() == 'android':
@@ -649,6 +698,7 @@ class NogoManager(ScreenManager):
         if 'emptyscreen' not in self.screen_names:
             self.add_widget(Screen(name='emptyscreen'))
     def make_board_match_view_mode(self, name):
+        from boardview import TabletBoardView, PhoneBoardView
         board = self.get_screen(name)
         if self.view_mode == 'tablet':
             if not isinstance(board.children[0], TabletBoardView):
@@ -656,7 +706,7 @@ class NogoManager(ScreenManager):
                 board = self.get_screen(name)
                 self.close_board(name)
                 board = board.children[0]
-                board.board.save_sgf()
+                board.board.save_sgf(wait=True)
                 filen = board.board.collectionsgf.filen
                 reconstruction_path = board.board.get_reconstruction()
                 new_pbv = self.new_board(from_file=filen,mode='Navigate')
@@ -669,7 +719,7 @@ class NogoManager(ScreenManager):
                 board = self.get_screen(name)
                 self.close_board(name)
                 board = board.children[0]
-                board.board.save_sgf()
+                board.board.save_sgf(wait=True)
                 filen = board.board.collectionsgf.filen
                 reconstruction_path = board.board.get_reconstruction()
                 new_pbv = self.new_board(from_file=filen,mode='Navigate')
@@ -821,7 +871,7 @@ class GobanApp(App):
     version = StringProperty('0.4.0')
     manager = ObjectProperty(None, allownone=True)
     navdrawer = ObjectProperty(None, allownone=True)
-    cache = ObjectProperty(WidgetCache())
+    cache = ObjectProperty(None,allownone=True)
     collections = ObjectProperty(None, allownone=True)
 
     stone_type = StringProperty('default')
@@ -840,7 +890,7 @@ class GobanApp(App):
 
     def build(self):
         print 'ENTERED BUILD()'
-        t1 = time()
+        t1 = record_startup_phase('app setup and kv loading',imports_end)
         # Load config
         #print 'user data dir is', self.user_data_dir
         config = self.config
@@ -865,7 +915,7 @@ class GobanApp(App):
                 if len(filestr) > 1:
                     name = filen.split('/')[-1]
                     copyfile(filen,'./collections/'+name)
-           
+        phase_start = record_startup_phase('build: sounds and backups',t1)
 
         # Load collections
         # self.collections = CollectionsList().from_file()
@@ -883,7 +933,7 @@ class GobanApp(App):
         # sm.add_widget(hv)
         # sm.create_collections_index()
 
-        t2 = time()
+        t2 = record_startup_phase('build: manager',phase_start)
         print 'CONSTRUCTED manager and home',t2-t1
 
         # Get initial settings from config panel
@@ -913,7 +963,8 @@ class GobanApp(App):
             
             
 
-        t3 = time()
+        t3 = record_startup_phase('build: settings and home screen',t2)
+        self.build_end = t3
         print 'RETURNING SM',t3-t2, t3-t1
 
         #drawer = NogoDrawer()
@@ -929,16 +980,50 @@ class GobanApp(App):
         
         return sm
 
+    def import_board_modules(self):
+        '''Imports the board, sgf and board widget modules, which are only
+        needed once a board is opened, and returns boardview.'''
+        if sys.modules.has_key('boardview'):
+            return sys.modules['boardview']
+        t1 = time()
+        import boardview
+        from abstractboard import position_cache
+        from widgetcache import WidgetCache
+        self.cache = WidgetCache()
+        position_cache.set_max_positions(int(self.config.getdefault('Board','position_cache_size','2000')))
+        print 'IMPORTED board modules in {0:.3f}s'.format(time()-t1)
+        return boardview
+
     def build_collections_list(self):
         if self.collections is None:
             self.collections = CollectionsList()
             cl = self.collections
-            #progress = CollectionProgress()
-            #cl.popup = progress
-            #progress.open()
-            #sleep(1)
             cl.from_file()
-            #progress.dismiss()
+        elif self.collections.loading:
+            self.collections.finish_loading()
+
+    def load_collections_in_background(self):
+        if self.collections is None:
+            self.collections = CollectionsList()
+            self.collections.load_in_background()
+            Clock.schedule_once(self.show_collection_progress,0.5)
+
+    def show_collection_progress(self,*args):
+        '''Shows a progress bar if collections are taking a while to
+        load.'''
+        cl = self.collections
+        if not cl.loading:
+            return
+        progress = CollectionProgress()
+        progress.length = cl.length
+        progress.progress = cl.progress
+        cl.bind(length=progress.set_length,progress=progress.set_progress)
+        def dismiss(instance,loading):
+            if not loading:
+                cl.unbind(length=progress.set_length,progress=progress.set_progress)
+                progress.dismiss()
+        cl.bind(loading=dismiss)
+        progress.open()
  
             
     def try_android_rotate(self,dir='portrait'):
@@ -1011,6 +1096,13 @@ class GobanApp(App):
 
         Clock.schedule_interval(self.save_all_boards,150)
 
+        # The home screen is already built, so collections can load
+        # without delaying startup
+        self.load_collections_in_background()
+
+        record_startup_phase('window and start',self.build_end)
+        print_startup_report()
+
     def my_key_handler(self,window,keycode1,keycode2,text,modifiers):
         if keycode1 == 27 or keycode1 == 1001:
             self.manager.handle_android_back()
@@ -1110,20 +1202,37 @@ class GobanApp(App):
                                 data=jsondata)
 
     def build_config(self, config):
-        config.setdefaults('Board',{'input_mode':'phone','view_mode':'phone','coordinates':False,'markers':True,'stone_graphics':'slate and shell','board_graphics':'board section photo 1','sounds':False})
+        config.setdefaults('Board',{'input_mode':'phone','view_mode':'phone','coordinates':False,'markers':True,'stone_graphics':'slate and shell','board_graphics':'board section photo 1','sounds':False,'position_cache_size':2000})
+        config.setdefaults('Collections',{'search_comments':False})
 
 
     def on_pause(self,*args,**kwargs):
         print 'App asked to pause'
         self.save_all_boards()
+        if self.collections is not None:
+            self.collections.compact()
+        if not self.wait_for_sgf_saves(5):
+            print 'Sgf saves still pending on pause'
         return True
 
     def on_stop(self,*args,**kwargs):
         print 'App asked to stop'
         self.save_all_boards()
+        if self.collections is not None:
+            self.collections.compact()
+        self.wait_for_sgf_saves()
         return super(GobanApp,self).on_stop()
 
+    def wait_for_sgf_saves(self,timeout=None):
+        '''Waits for the background sgf saves queued by save_all_boards.
+        Nothing can be queued if no board has been opened.'''
+        if not sys.modules.has_key('abstractboard'):
+            return True
+        return sys.modules['abstractboard'].sgf_saver.wait(timeout)
+
     def save_all_boards(self,*args):
+        '''Queues a background save of every open board with unsaved
+        changes.'''
         names = self.manager.screen_names
         for name in names:
             if name[:5] == 'Board':
@@ -1198,7 +1307,7 @@ class GobanApp(App):
         collectionsgf.collection = collection
         collectionsgf.filen = collectionsgf.get_default_filen() + '.sgf'
         collection.games.append(collectionsgf)
-        collection.save()
+        collection.save_game(collectionsgf)
         self.manager.add_collection_refresh_reminder(collection)
         self.manager.add_collection_refresh_reminder(oldcollection)
         self.manager.collectionindex_to_refresh = True
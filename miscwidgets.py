@@ -2,6 +2,7 @@ from kivy.uix.widget import Widget
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.button import Button
 from kivy.uix.textinput import TextInput
+from kivy.uix.spinner import SpinnerOption
 from kivy.properties import NumericProperty, ReferenceListProperty, ObjectProperty, ListProperty, AliasProperty, StringProperty, DictProperty, BooleanProperty, StringProperty, OptionProperty
 
 class AndroidTextInput(TextInput):
@@ -46,3 +47,5 @@ class NumberChooser(BoxLayout):
         if self.number > self.number_min:
             self.number -= 1
 
+class MySpinnerOption(SpinnerOption):
+    pass
@@ -558,7 +558,7 @@ demonstrate the use of kv templates and composite list views.
 '''
 
 __all__ = ('SelectableView', 'ListItemButton', 'ListItemLabel',
-           'CompositeListItem', 'ListView', )
+           'CompositeListItem', 'ListModel', 'ModelListAdapter', 'ListView', )
 
 from kivy.event import EventDispatcher
 from kivy.clock import Clock
@@ -567,6 +567,7 @@ from kivy.uix.button import Button
 from kivy.uix.label import Label
 from kivy.uix.boxlayout import BoxLayout
 from kivy.adapters.simplelistadapter import SimpleListAdapter
+from kivy.adapters.listadapter import ListAdapter
 from kivy.uix.abstractview import AbstractView
 from kivy.properties import ObjectProperty, DictProperty, \
         NumericProperty, ListProperty, BooleanProperty
@@ -794,6 +795,288 @@ class CompositeListItem(SelectableView, BoxLayout):
             return '<%s>' % (self.__class__.__name__)
 
 
+def reset_to_default(widget, key):
+    '''Sets a property of a widget back to its default value.'''
+    try:
+        prop = widget.property(key)
+    except (KeyError, AttributeError):
+        return
+    try:
+        setattr(widget, key, prop.defaultvalue)
+    except ValueError:
+        pass
+
+
+def _all_same(first, second):
+    for a, b in zip(first, second):
+        if a is not b:
+            return False
+    return True
+
+
+class ListModel(EventDispatcher):
+    ''':class:`ListModel` is a list of rows that reports each change as an
+    event, so that a :class:`ListView` showing it through a
+    :class:`ModelListAdapter` only creates views for rows that changed.
+
+    :Events:
+        `on_insert`: (index, count)
+            Fired after count rows are inserted at index.
+        `on_remove`: (index, count)
+            Fired after count rows are removed from index.
+        `on_update`: (index, count)
+            Fired when count rows from index must be redrawn.
+        `on_reset`: ()
+            Fired when every row has been replaced.
+    '''
+
+    __events__ = ('on_insert', 'on_remove', 'on_update', 'on_reset')
+
+    def __init__(self, rows=None, **kwargs):
+        self.rows = list(rows) if rows is not None else []
+        super(ListModel, self).__init__(**kwargs)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        return self.rows[index]
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def insert_rows(self, index, rows):
+        self.rows[index:index] = rows
+        if rows:
+            self.dispatch('on_insert', index, len(rows))
+
+    def append(self, row):
+        self.insert_rows(len(self.rows), [row])
+
+    def remove_rows(self, index, count=1):
+        del self.rows[index:index + count]
+        if count:
+            self.dispatch('on_remove', index, count)
+
+    def remove(self, row):
+        self.remove_rows(self.rows.index(row))
+
+    def update_rows(self, index, count=1):
+        if count:
+            self.dispatch('on_update', index, count)
+
+    def update(self, row):
+        '''Redraws the row if it is in the model.'''
+        if row in self.rows:
+            self.update_rows(self.rows.index(row))
+
+    def reset(self, rows):
+        self.rows = list(rows)
+        self.dispatch('on_reset')
+
+    def set_rows(self, rows):
+        '''Replaces the rows, firing events for only the differing run
+        between the rows common to the start and end of the old and new
+        lists. Adding, removing or moving a single row then changes only
+        that row, while a reordering of the whole list is a reset.'''
+        old = self.rows
+        rows = list(rows)
+        start = 0
+        end = min(len(old), len(rows))
+        while start < end and old[start] is rows[start]:
+            start += 1
+        old_end = len(old)
+        new_end = len(rows)
+        while (old_end > start and new_end > start and
+               old[old_end - 1] is rows[new_end - 1]):
+            old_end -= 1
+            new_end -= 1
+        if start == 0 and old_end == len(old) and new_end == len(rows):
+            if old or rows:
+                self.reset(rows)
+            return
+        old_middle = old[start:old_end]
+        new_middle = rows[start:new_end]
+        if len(old_middle) == len(new_middle) > 1:
+            # A single row moved forwards or backwards
+            if (old_middle[0] is new_middle[-1] and
+                    _all_same(old_middle[1:], new_middle[:-1])):
+                self.remove_rows(start)
+                self.insert_rows(new_end - 1, [new_middle[-1]])
+                return
+            if (old_middle[-1] is new_middle[0] and
+                    _all_same(old_middle[:-1], new_middle[1:])):
+                self.remove_rows(old_end - 1)
+                self.insert_rows(start, [new_middle[0]])
+                return
+        self.remove_rows(start, old_end - start)
+        self.insert_rows(start, new_middle)
+
+    def on_insert(self, index, count):
+        pass
+
+    def on_remove(self, index, count):
+        pass
+
+    def on_update(self, index, count):
+        pass
+
+    def on_reset(self):
+        pass
+
+
+class ModelListAdapter(ListAdapter):
+    ''':class:`ModelListAdapter` is a
+    :class:`~kivy.adapters.listadapter.ListAdapter` whose data is the rows of
+    a :class:`ListModel`. Instead of dropping every cached view when the data
+    changes, it moves the cached views of rows that didn't change to their
+    new indices, and drops only those of changed rows.
+
+    Views are only kept for the rows the :class:`ListView` is showing. The
+    views of rows scrolled out of the window, other than selected ones, go
+    into a pool and are reused for the next rows shown, by setting the
+    attributes returned by the args_converter on them. Each row's
+    args_converter must therefore return every attribute its view shows;
+    attributes it leaves out are reset to the property's default.
+
+    Only views made from :attr:`cls` are recycled; template views are
+    created and dropped as with :class:`~kivy.adapters.listadapter.ListAdapter`.
+    '''
+
+    model = ObjectProperty(None)
+    '''The :class:`ListModel` holding the rows.
+
+    :data:`model` is an :class:`~kivy.properties.ObjectProperty`, default to
+    None.
+    '''
+
+    rows_changed = NumericProperty(0)
+    '''Incremented after each change to the rows, so that the view can
+    redraw.
+    '''
+
+    max_recycled = NumericProperty(40)
+    '''The largest number of unused views kept for reuse.
+
+    :data:`max_recycled` is a :class:`~kivy.properties.NumericProperty`,
+    default to 40.
+    '''
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('data', [])
+        self.recycled = []
+        super(ModelListAdapter, self).__init__(**kwargs)
+        self.model.bind(on_insert=self.rows_inserted,
+                        on_remove=self.rows_removed,
+                        on_update=self.rows_updated,
+                        on_reset=self.rows_reset)
+
+    def get_count(self):
+        return len(self.model.rows)
+
+    def get_data_item(self, index):
+        if index < 0 or index >= len(self.model.rows):
+            return None
+        return self.model.rows[index]
+
+    def bind_triggers_to_view(self, func):
+        self.bind(data=func, rows_changed=func)
+
+    def unbind_triggers_from_view(self, func):
+        self.unbind(data=func, rows_changed=func)
+
+    def create_view(self, index):
+        item = self.get_data_item(index)
+        if item is None:
+            return None
+        if self.cls is None:
+            return super(ModelListAdapter, self).create_view(index)
+        item_args = self.args_converter(index, item)
+        if self.recycled:
+            view = self.recycled.pop()
+            for key in view.row_keys:
+                if key not in item_args:
+                    reset_to_default(view, key)
+            for key, value in item_args.items():
+                setattr(view, key, value)
+        else:
+            view = self.cls(**item_args)
+            view.bind(on_release=self.handle_selection)
+        view.row_keys = item_args.keys()
+        view.index = index
+        return view
+
+    def recycle(self, view):
+        if self.cls is None or len(self.recycled) >= self.max_recycled:
+            return
+        if view.is_selected:
+            view.deselect()
+        self.recycled.append(view)
+
+    def release_views(self, start, end):
+        '''Keeps the cached views of rows start to end, and of selected
+        rows, and recycles the rest.'''
+        cached_views = self.cached_views
+        for index in cached_views.keys():
+            if start <= index <= end:
+                continue
+            view = cached_views[index]
+            if view in self.selection:
+                continue
+            del cached_views[index]
+            self.recycle(view)
+
+    def delete_cache(self, *args):
+        for view in self.cached_views.values():
+            self.recycle(view)
+        self.cached_views = {}
+
+    def drop_views(self, start, end):
+        '''Forgets the cached views of rows start to end, deselecting
+        them.'''
+        cached_views = self.cached_views
+        for index in range(start, end):
+            view = cached_views.pop(index, None)
+            if view is None:
+                continue
+            if view in self.selection:
+                view.deselect()
+                self.selection.remove(view)
+                self.dispatch('on_selection_change')
+            self.recycle(view)
+
+    def shift_views(self, start, offset):
+        '''Moves the cached views of rows from start on by offset.'''
+        moved = {}
+        for index, view in self.cached_views.items():
+            if index >= start:
+                index += offset
+                view.index = index
+            moved[index] = view
+        self.cached_views = moved
+
+    def rows_inserted(self, model, index, count):
+        self.shift_views(index, count)
+        self.rows_changed += 1
+
+    def rows_removed(self, model, index, count):
+        self.drop_views(index, index + count)
+        self.shift_views(index + count, -1 * count)
+        self.check_for_empty_selection()
+        self.rows_changed += 1
+
+    def rows_updated(self, model, index, count):
+        self.drop_views(index, index + count)
+        self.rows_changed += 1
+
+    def rows_reset(self, model):
+        for view in self.selection:
+            view.deselect()
+        self.delete_cache()
+        self.initialize_selection()
+        self.rows_changed += 1
+
+
 Builder.load_string('''
 <ListView>:
     container: container
@@ -915,18 +1198,45 @@ class ListView(AbstractView, EventDispatcher):
         super(ListView, self).__init__(**kwargs)
 
         self._trigger_populate = Clock.create_trigger(self._spopulate, -1)
+        # The adapter whose triggers are bound to this view
+        self._bound_adapter = None
 
         self.bind(size=self._trigger_populate,
                   pos=self._trigger_populate,
                   item_strings=self.item_strings_changed,
                   adapter=self._trigger_populate)
+        self.bind(adapter=self.adapter_changed)
 
         # The bindings setup above sets self._trigger_populate() to fire
         # when the adapter changes, but we also need this binding for when
         # adapter.data and other possible triggers change for view updating.
         # We don't know that these are, so we ask the adapter to set up the
         # bindings back to the view updating function here.
-        self.adapter.bind_triggers_to_view(self._trigger_populate)
+        self.adapter_changed(self, self.adapter)
+
+    def adapter_changed(self, instance, adapter):
+        old_adapter = self._bound_adapter
+        if old_adapter is not None:
+            if isinstance(old_adapter, ModelListAdapter):
+                old_adapter.unbind_triggers_from_view(self._trigger_populate)
+                old_adapter.unbind(rows_changed=self._rows_changed)
+            else:
+                # Kivy's adapters only bind data to the view
+                old_adapter.unbind(data=self._trigger_populate)
+        self._bound_adapter = adapter
+        if adapter is None:
+            return
+        adapter.bind_triggers_to_view(self._trigger_populate)
+        if isinstance(adapter, ModelListAdapter):
+            adapter.bind(rows_changed=self._rows_changed)
+
+    def _rows_changed(self, adapter, *args):
+        '''Resizes the container when rows are inserted or removed by a
+        :class:`ModelListAdapter`. The rows that didn't change keep their
+        views, so populate only creates views for the changed ones.'''
+        if adapter is not self.adapter or self.row_height is None:
+            return
+        self.container.height = self.row_height * adapter.get_count()
 
     # Added to set data when item_strings is set in a kv template, but it will
     # be good to have also if item_strings is reset generally.
@@ -996,6 +1306,7 @@ class ListView(AbstractView, EventDispatcher):
                     continue
                 sizes[index] = item_view.height
                 container.add_widget(item_view)
+            self._release_views(istart, iend)
         else:
             available_height = self.height
             real_height = 0
@@ -1013,6 +1324,7 @@ class ListView(AbstractView, EventDispatcher):
                 real_height += item_view.height
 
             self._count = count
+            self._release_views(self._index, index - 1)
 
             # extrapolate the full size of the container from the size
             # of view instances in the adapter
@@ -1022,6 +1334,11 @@ class ListView(AbstractView, EventDispatcher):
                 if self.row_height is None:
                     self.row_height = real_height / count
 
+    def _release_views(self, istart, iend):
+        # Only a ModelListAdapter recycles the views of rows not shown
+        if isinstance(self.adapter, ModelListAdapter):
+            self.adapter.release_views(istart, iend)
+
     def scroll_to(self, index=0):
         if not self.scrolling:
             self.scrolling = True
@@ -0,0 +1,327 @@
+# Copyright 2013 Alexander Taylor
+
+# This file is part of noGo.
+
+# noGo is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+# noGo is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with noGo. If not, see http://www.gnu.org/licenses/gpl-3.0.txt
+
+'''
+Provides the PatternIndex class, an index of the local shapes in the
+corner and side regions of every game in a collection, used to answer
+'which games contain this shape, and what was played next'.
+
+Shapes are normalised under the 8 board symmetries and colour swap, so
+a shape is found whichever corner or side it was played in and
+whichever player played it.
+
+'''
+
+import random
+
+from gomill import sgf, boards
+
+from positionindex import HashIndex, get_search_index
+
+NO_MOVE = 0xffff
+# Bits of the flags column
+NEXT_BLACK = 1
+NEXT_AFTER_TENUKI = 2
+
+def get_transforms(side):
+    '''Returns the 8 symmetries of a board as functions of (row, col).'''
+    m = side - 1
+    return [lambda r, c: (r, c),
+            lambda r, c: (c, m-r),
+            lambda r, c: (m-r, m-c),
+            lambda r, c: (m-c, r),
+            lambda r, c: (c, r),
+            lambda r, c: (r, m-c),
+            lambda r, c: (m-r, c),
+            lambda r, c: (m-c, m-r),
+            ]
+
+def get_canonical_regions(side):
+    '''Returns a list of (kind, points) for the regions in their
+    canonical orientation: the corner at (0, 0), and the side along
+    row 0. The other corners and sides are found by symmetry.'''
+    corner = side // 2
+    regions = [('corner', [(r, c) for r in range(corner)
+                           for c in range(corner)])]
+    if side >= 13:
+        depth = side // 3
+        halfwidth = side // 4
+        regions.append(('side', [(r, c) for r in range(depth)
+                                 for c in range(side//2 - halfwidth,
+                                                side//2 + halfwidth + 1)]))
+    return regions
+
+class RegionLayout(object):
+    '''Every region of a board of a given size, viewed through each
+    symmetry. Views of the same board points form a group, and a
+    group's pattern key is the smallest hash over its views and both
+    colourings.'''
+    def __init__(self, side):
+        self.side = side
+        self.view_transforms = []
+        self.view_inverses = []
+        self.view_points = []
+        self.groups = []
+        self.group_kinds = []
+        # board point -> list of (view, black value, white value)
+        self.updates = {}
+        rand = random.Random(0x5bd1e995 + side)
+        group_by_points = {}
+        for kind, points in get_canonical_regions(side):
+            values = dict([(point, (rand.getrandbits(64), rand.getrandbits(64)))
+                           for point in points])
+            for transform in get_transforms(side):
+                view = len(self.view_transforms)
+                board_points = [transform(*point) for point in points]
+                self.view_transforms.append(transform)
+                self.view_inverses.append(dict(zip(board_points, points)))
+                self.view_points.append(board_points)
+                for point, board_point in zip(points, board_points):
+                    black, white = values[point]
+                    self.updates.setdefault(board_point, []).append(
+                        (view, black, white))
+                key = (kind, frozenset(board_points))
+                if not group_by_points.has_key(key):
+                    group_by_points[key] = len(self.groups)
+                    self.groups.append([])
+                    self.group_kinds.append(kind)
+                self.groups[group_by_points[key]].append(view)
+        self.view_groups = [None] * len(self.view_transforms)
+        for group, views in enumerate(self.groups):
+            for view in views:
+                self.view_groups[view] = group
+
+    def new_hashes(self):
+        '''Returns a pair of lists holding the hash of each view, with
+        colours as played and with colours swapped.'''
+        return [0] * len(self.view_transforms), [0] * len(self.view_transforms)
+
+    def update_hashes(self, hashes, point, old, new):
+        '''Updates view hashes for a change of the colour at point, and
+        returns the set of groups that changed.'''
+        plain, swapped = hashes
+        changed = set()
+        for view, black, white in self.updates.get(point, ()):
+            for colour in (old, new):
+                if colour == 'b':
+                    plain[view] ^= black
+                    swapped[view] ^= white
+                elif colour == 'w':
+                    plain[view] ^= white
+                    swapped[view] ^= black
+            changed.add(self.view_groups[view])
+        return changed
+
+    def hashes_from_board(self, get):
+        '''Returns view hashes for a whole board, where get(row, col)
+        returns 'b', 'w' or None.'''
+        hashes = self.new_hashes()
+        for point in self.updates:
+            colour = get(*point)
+            if colour is not None:
+                self.update_hashes(hashes, point, None, colour)
+        return hashes
+
+    def get_group_keys(self, hashes, group):
+        '''Returns the canonical key of a group and the list of
+        (view, swapped) orientations that produce it.'''
+        plain, swapped = hashes
+        candidates = []
+        for view in self.groups[group]:
+            candidates.append((plain[view], view, False))
+            candidates.append((swapped[view], view, True))
+        key = min(candidates)[0]
+        return key, [(view, swap) for value, view, swap in candidates
+                     if value == key]
+
+    def group_contains(self, group, point):
+        return self.view_inverses[self.groups[group][0]].has_key(point)
+
+    def to_canonical(self, view, swap, point, colour):
+        '''Returns the canonical code and colour of a board move.'''
+        row, col = self.view_inverses[view][point]
+        if swap:
+            colour = {'b':'w', 'w':'b'}[colour]
+        return row * self.side + col, colour
+
+    def from_canonical(self, view, swap, code, colour):
+        '''Returns the board point and colour of a canonical move.'''
+        point = self.view_transforms[view](*divmod(code, self.side))
+        if swap:
+            colour = {'b':'w', 'w':'b'}[colour]
+        return point, colour
+
+_layouts = {}
+def get_layout(side):
+    if not _layouts.has_key(side):
+        _layouts[side] = RegionLayout(side)
+    return _layouts[side]
+
+def get_pattern_records(game, game_index=0):
+    '''Walks the game's main line and returns a (key, game_index,
+    move_number, next_code, flags) record for every corner or side shape
+    it passes through. The next move is the first later move played in
+    the same region, if any.'''
+    side = game.get_size()
+    layout = get_layout(side)
+    hashes = layout.new_hashes()
+    board = boards.Board(side)
+    records = []
+    pending = {}
+
+    def finish(group, move_number, point=None, colour=None):
+        key, orientations, start = pending.pop(group)
+        if point is None:
+            records.append((key, game_index, start, NO_MOVE, 0))
+            return
+        code, colour = min([layout.to_canonical(view, swap, point, colour)
+                            for view, swap in orientations])
+        flags = 0
+        if colour == 'b':
+            flags |= NEXT_BLACK
+        if move_number != start + 1:
+            flags |= NEXT_AFTER_TENUKI
+        records.append((key, game_index, start, code, flags))
+
+    for move_number, node in enumerate(game.get_main_sequence()):
+        changes = []
+        if node.has_setup_stones():
+            black, white, empty = node.get_setup_stones()
+            for points, colour in ((black, 'b'), (white, 'w'), (empty, None)):
+                for row, col in points:
+                    changes.append(((row, col), board.get(row, col), colour))
+                    board.set(row, col, colour)
+        colour, point = node.get_move()
+        if point is not None:
+            row, col = point
+            changes.append((point, board.get(row, col), colour))
+            try:
+                ko_point, captured = board.play_with_captures(row, col, colour)
+                for captured_colour, captured_point in captured:
+                    changes.append((captured_point, captured_colour, None))
+            except ValueError:
+                board.set(row, col, colour)
+        changed = set()
+        for changed_point, old, new in changes:
+            if old != new:
+                changed.update(layout.update_hashes(hashes, changed_point, old, new))
+        if point is not None:
+            for group in pending.keys():
+                if layout.group_contains(group, point):
+                    finish(group, move_number, point, colour)
+        for group in changed:
+            if pending.has_key(group):
+                finish(group, move_number)
+            key, orientations = layout.get_group_keys(hashes, group)
+            # An empty region has a zero hash, and tells us nothing
+            if key != 0:
+                pending[group] = (key, orientations, move_number)
+    for group in pending.keys():
+        finish(group, None)
+    return records
+
+class PatternIndex(HashIndex):
+    '''Maps corner and side shape keys to the games and move numbers
+    they occur at, and the next move played in the region.'''
+    suffix = '.patindex'
+    columns = HashIndex.columns + (('next_moves','H'), ('flags','B'))
+    def get_game_records(self, filen, game_index):
+        with open(filen, 'r') as fileh:
+            game = sgf.Sgf_game.from_string(fileh.read())
+        return get_pattern_records(game, game_index)
+    def find(self, key):
+        '''Returns a list of (filen, move_number, next_code, flags) for
+        every occurrence of the shape.'''
+        return [(self.filens[self.game_indices[i]], self.move_numbers[i],
+                 self.next_moves[i], self.flags[i])
+                for i in self.find_entries(key)]
+
+class PatternResult(object):
+    '''The games containing one region's shape, and the moves played
+    next there, in board coordinates.'''
+    def __init__(self, kind, points):
+        self.kind = kind
+        self.points = points
+        self.games = []
+        self.continuations = {}
+        self.tenuki = 0
+        self.unfinished = 0
+    def __str__(self):
+        return 'PatternResult for {0} shape, {1} games, {2} continuations'.format(
+            self.kind, len(self.games), len(self.continuations))
+    def __repr__(self):
+        return self.__str__()
+    def sorted_continuations(self):
+        '''Returns a list of ((point, colour), count), most played
+        first.'''
+        return sorted(self.continuations.items(), key=lambda j: -1*j[1])
+
+def find_patterns_in_collections(collections, get, side=19, indexes=None):
+    '''Looks up the shape in every corner and side region of a board,
+    where get(row, col) returns 'b', 'w' or None. Returns a list of
+    PatternResults for the regions that were found, with the games as
+    (collectionsgf, move_number) pairs. indexes may give the up to date
+    PatternIndex of each collection by name.'''
+    layout = get_layout(side)
+    hashes = layout.hashes_from_board(get)
+    queries = []
+    for group in range(len(layout.groups)):
+        key, orientations = layout.get_group_keys(hashes, group)
+        if key != 0:
+            queries.append((group, key, orientations))
+    if not queries:
+        return []
+
+    results = {}
+    for collection in collections:
+        index = get_search_index(collection, indexes, PatternIndex)
+        matches = []
+        for group, key, orientations in queries:
+            found = index.find(key)
+            if found:
+                matches.append((group, orientations, found))
+        if not matches:
+            continue
+        collection.finish_lazy_loading()
+        games_by_filen = {}
+        for game in collection.games:
+            games_by_filen[game.filen] = game
+        for group, orientations, found in matches:
+            if not results.has_key(group):
+                view = orientations[0][0]
+                results[group] = PatternResult(layout.group_kinds[group],
+                                               layout.view_points[view])
+            result = results[group]
+            seen = set()
+            for filen, move_number, next_code, flags in found:
+                if games_by_filen.has_key(filen) and filen not in seen:
+                    seen.add(filen)
+                    result.games.append((games_by_filen[filen], move_number))
+                if next_code == NO_MOVE:
+                    result.unfinished += 1
+                    continue
+                if flags & NEXT_AFTER_TENUKI:
+                    result.tenuki += 1
+                colour = 'b' if flags & NEXT_BLACK else 'w'
+                # A symmetric shape has several orientations, and each
+                # equivalent of the move is shown
+                moves = set([layout.from_canonical(view, swap, next_code, colour)
+                             for view, swap in orientations])
+                for move in moves:
+                    result.continuations[move] = result.continuations.get(move, 0) + 1
+    return sorted(results.values(), key=lambda j: -1*len(j.games))
+
+if __name__ == '__main__':
+    from sgfcollections import CollectionsList
+    from positionindex import build_collection_index
+    collections = CollectionsList().from_file()
+    for collection in collections.collections:
+        print 'Indexing patterns in', collection.name
+        print build_collection_index(collection, PatternIndex)
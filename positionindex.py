@@ -0,0 +1,308 @@
+# Copyright 2013 Alexander Taylor
+
+# This file is part of noGo.
+
+# noGo is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+# noGo is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with noGo. If not, see http://www.gnu.org/licenses/gpl-3.0.txt
+
+'''
+Provides the PositionIndex class, an on-disk index of the Zobrist hash of
+every position along the main line of every game in a collection. It
+answers 'which games pass through this position, and at which move'
+without parsing any sgf files.
+
+'''
+
+import json
+import threading
+from array import array
+from bisect import bisect_left
+from os.path import exists, getmtime
+
+from gomill import sgf, boards
+
+INDEX_VERSION = 1
+
+def get_main_line_hashes(game):
+    '''Returns the Zobrist hash of the position at every node of the
+    game's main line, starting with the root. Setup stones are applied
+    without captures, as in abstractboard, so the hashes match those of
+    AbstractBoard.get_position_hash.'''
+    board = boards.Board(game.get_size())
+    hashes = []
+    for node in game.get_main_sequence():
+        if node.has_setup_stones():
+            black, white, empty = node.get_setup_stones()
+            for row, col in black:
+                board.set(row, col, 'b')
+            for row, col in white:
+                board.set(row, col, 'w')
+            for row, col in empty:
+                board.set(row, col, None)
+        colour, point = node.get_move()
+        if point is not None:
+            try:
+                board.play(point[0], point[1], colour)
+            except ValueError:
+                board.set(point[0], point[1], colour)
+        hashes.append(board.zobrist_hash())
+    return hashes
+
+def get_stamp(filen):
+    '''Returns the mtime an indexed sgf is compared by, or None if it
+    does not exist.'''
+    try:
+        return getmtime(filen)
+    except OSError:
+        return None
+
+def get_main_line_hashes_from_file(filen):
+    with open(filen, 'r') as fileh:
+        game = sgf.Sgf_game.from_string(fileh.read())
+    return get_main_line_hashes(game)
+
+class HashIndex(object):
+    '''Base class for indexes of 64 bit hashes over the games of a
+    collection.
+
+    Entries are held in parallel arrays sorted by hash, so a lookup is a
+    binary search. Hashes are split into two 32 bit halves because the
+    size of a 64 bit array type differs between platforms. Subclasses add
+    columns after the game index and move number, and implement
+    get_game_records(filen, game_index), returning the records of one
+    sgf as taken by set_records, or raising IOError or ValueError if it
+    can't be read.
+
+    The mtime of every indexed sgf is stored with it, so that updated
+    only re-reads the games that were added or changed. Games that could
+    not be read are listed in skipped.'''
+    suffix = '.index'
+    version = 3
+    columns = (('hash_his','I'), ('hash_los','I'), ('game_indices','I'),
+               ('move_numbers','H'))
+    def __init__(self):
+        self.filens = []
+        self.stamps = []
+        self.skipped = []
+        for name, typecode in self.columns:
+            setattr(self, name, array(typecode))
+    def __str__(self):
+        return '{0} of {1} entries in {2} games'.format(
+            self.__class__.__name__, len(self.hash_his), len(self.filens))
+    def __repr__(self):
+        return self.__str__()
+    def set_records(self, filens, records, stamps=None, skipped=()):
+        '''Fills the index from a list of (hash, game_index, move_number,
+        ...) tuples, with one entry after the hash for each column.'''
+        records.sort()
+        self.filens = list(filens)
+        if stamps is None:
+            stamps = [get_stamp(filen) for filen in filens]
+        self.stamps = list(stamps)
+        self.skipped = list(skipped)
+        self.hash_his = array('I', [entry[0] >> 32 for entry in records])
+        self.hash_los = array('I', [entry[0] & 0xffffffff for entry in records])
+        for i, (name, typecode) in enumerate(self.columns[2:]):
+            setattr(self, name, array(typecode, [entry[i+1] for entry in records]))
+        return self
+    def get_records(self, game_indices):
+        '''Returns the records of the games in game_indices, a dict of
+        old game index to the game index each should be renumbered to.'''
+        columns = [getattr(self, name) for name, typecode in self.columns[3:]]
+        records = []
+        for i, old_index in enumerate(self.game_indices):
+            if not game_indices.has_key(old_index):
+                continue
+            records.append(((self.hash_his[i] << 32) | self.hash_los[i],
+                            game_indices[old_index]) +
+                           tuple([column[i] for column in columns]))
+        return records
+    def updated(self, filens, progress=None):
+        '''Returns an index covering exactly the given sgf files, with the
+        entries of unchanged games copied from this one and only new or
+        changed games read. progress, if given, is called with (done,
+        total) after each game read. Returns self if nothing changed, so
+        an index that may be in use is never modified.'''
+        filens = list(filens)
+        stamps = [get_stamp(filen) for filen in filens]
+        old_stamps = dict(zip(self.filens, self.stamps))
+        old_indices = dict([(filen, i) for i, filen in enumerate(self.filens)])
+        kept = {}
+        changed = []
+        for game_index, filen in enumerate(filens):
+            if (old_stamps.has_key(filen) and
+                old_stamps[filen] == stamps[game_index]):
+                kept[old_indices[filen]] = game_index
+            else:
+                changed.append((game_index, filen))
+        if not changed and self.filens == filens:
+            return self
+        records = self.get_records(kept)
+        old_skipped = set(self.skipped)
+        skipped = [self.filens[old_index] for old_index in kept
+                   if self.filens[old_index] in old_skipped]
+        for number, (game_index, filen) in enumerate(changed):
+            try:
+                records.extend(self.get_game_records(filen, game_index))
+            except (IOError, ValueError):
+                print 'Could not index', filen
+                skipped.append(filen)
+            if progress is not None:
+                progress(number + 1, len(changed))
+        return self.__class__().set_records(filens, records, stamps, skipped)
+    def build(self, filens, progress=None):
+        '''Returns a new index of every game in filens.'''
+        return self.__class__().updated(filens, progress)
+    def find_entries(self, position_hash):
+        '''Returns the indices of every entry with the given hash.'''
+        hi = position_hash >> 32
+        lo = position_hash & 0xffffffff
+        hash_his = self.hash_his
+        hash_los = self.hash_los
+        entries = []
+        i = bisect_left(hash_his, hi)
+        while i < len(hash_his) and hash_his[i] == hi:
+            if hash_los[i] == lo:
+                entries.append(i)
+            i += 1
+        return entries
+    def save(self, filen):
+        header = json.dumps([self.version, self.filens, self.stamps,
+                             self.skipped, len(self.hash_his)])
+        with open(filen, 'wb') as fileh:
+            fileh.write(header + '\n')
+            for name, typecode in self.columns:
+                getattr(self, name).tofile(fileh)
+        return filen
+    def load(self, filen):
+        with open(filen, 'rb') as fileh:
+            header = json.loads(fileh.readline())
+            if header[0] != self.version:
+                raise ValueError('Index version not recognised.')
+            version, filens, stamps, skipped, length = header
+            self.filens = [entry.encode('utf-8') for entry in filens]
+            self.stamps = stamps
+            self.skipped = [entry.encode('utf-8') for entry in skipped]
+            for name, typecode in self.columns:
+                column = array(typecode)
+                column.fromfile(fileh, length)
+                setattr(self, name, column)
+        return self
+
+class PositionIndex(HashIndex):
+    '''Maps position hashes to (sgf filename, move number) pairs.'''
+    suffix = '.posindex'
+    def get_game_records(self, filen, game_index):
+        hashes = get_main_line_hashes_from_file(filen)
+        # Every game passes through the empty board
+        return [(position_hash, game_index, move_number)
+                for move_number, position_hash in enumerate(hashes)
+                if position_hash != 0]
+    def find(self, position_hash):
+        '''Returns a list of (filen, move_number) for every indexed game
+        reaching the position.'''
+        return [(self.filens[self.game_indices[i]], self.move_numbers[i])
+                for i in self.find_entries(position_hash)]
+
+# Loaded indexes by index filename, with the mtime they were loaded at
+_loaded_indexes = {}
+# Held while an index is loaded or updated, as indexes may be updated
+# from a background thread
+_index_lock = threading.RLock()
+
+def get_index_filen(collection, index_class=PositionIndex):
+    return get_index_filen_by_name(collection.name, index_class)
+
+def get_index_filen_by_name(name, index_class=PositionIndex):
+    return '.' + '/collections/' + name + index_class.suffix
+
+def load_index(filen, index_class=PositionIndex):
+    '''Returns the index saved in filen, or an empty index if there is
+    none or it cannot be read.'''
+    if not exists(filen):
+        return index_class()
+    mtime = getmtime(filen)
+    if _loaded_indexes.has_key(filen):
+        index, loaded_mtime = _loaded_indexes[filen]
+        if loaded_mtime == mtime:
+            return index
+    try:
+        index = index_class().load(filen)
+        _loaded_indexes[filen] = (index, mtime)
+        return index
+    except (IOError, ValueError, EOFError):
+        print 'Index unreadable, rebuilding', filen
+        return index_class()
+
+def get_index(name, filens, index_class=PositionIndex, progress=None):
+    '''Returns the index of the given class for the named collection,
+    covering the given sgf files. Games added or changed since the index
+    was saved are read and the index is saved again. Safe to call from a
+    background thread.'''
+    filen = get_index_filen_by_name(name, index_class)
+    with _index_lock:
+        saved = load_index(filen, index_class)
+        index = saved.updated(filens, progress)
+        if index is not saved or not exists(filen):
+            try:
+                index.save(filen)
+                _loaded_indexes[filen] = (index, getmtime(filen))
+            except IOError:
+                print 'Could not save index', filen
+        return index
+
+def get_collection_index(collection, index_class=PositionIndex):
+    '''Returns the index of the given class for a collection, updated
+    to match its current games.'''
+    collection.finish_lazy_loading()
+    return get_index(collection.name,
+                     [game.filen for game in collection.games], index_class)
+
+def build_collection_index(collection, index_class=PositionIndex):
+    '''Reads every game of the collection into a new index, replacing
+    any saved one.'''
+    collection.finish_lazy_loading()
+    index = index_class().build([game.filen for game in collection.games])
+    filen = get_index_filen(collection, index_class)
+    with _index_lock:
+        try:
+            index.save(filen)
+            _loaded_indexes[filen] = (index, getmtime(filen))
+        except IOError:
+            print 'Could not save index', filen
+    return index
+
+def get_search_index(collection, indexes, index_class=PositionIndex):
+    '''Returns the collection's index from indexes, a dict of collection
+    name to index already brought up to date, or gets it otherwise.'''
+    if indexes is not None and indexes.has_key(collection.name):
+        return indexes[collection.name]
+    return get_collection_index(collection, index_class)
+
+def find_position_in_collections(collections, position_hash, indexes=None):
+    '''Returns a list of (collectionsgf, move_number) for every game in
+    the given collections that reaches the position. indexes may give
+    the up to date index of each collection by name.'''
+    results = []
+    for collection in collections:
+        matches = get_search_index(collection, indexes).find(position_hash)
+        if not matches:
+            continue
+        collection.finish_lazy_loading()
+        games_by_filen = {}
+        for game in collection.games:
+            games_by_filen[game.filen] = game
+        for filen, move_number in matches:
+            if games_by_filen.has_key(filen):
+                results.append((games_by_filen[filen], move_number))
+    return results
+
+if __name__ == '__main__':
+    from sgfcollections import CollectionsList
+    collections = CollectionsList().from_file()
+    for collection in collections.collections:
+        print 'Indexing positions in', collection.name
+        print build_collection_index(collection)
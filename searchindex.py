@@ -0,0 +1,381 @@
+# Copyright 2013 Alexander Taylor
+
+# This file is part of noGo.
+
+# noGo is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+# noGo is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with noGo. If not, see http://www.gnu.org/licenses/gpl-3.0.txt
+
+'''
+Provides the SearchIndex class, an in-memory inverted index over the game
+info of every game in the collections, and optionally the comments in
+their sgf files. It answers queries like
+
+    bname:Shusaku result:W+ date:1850..1860
+
+Every term must match. A field:value term matches games with a word in
+that field starting with value, a field:low..high term matches games
+whose number for the field (the year, for dates) is in that range, and a
+term without a field matches a word in any field. Quoted values match
+several words, e.g. event:"honinbo sen".
+
+The module level search_index is kept up to date by sgfcollections once
+it has been built.
+
+'''
+
+import re
+import json
+from bisect import bisect_left, bisect_right
+from os.path import exists, getmtime
+
+from gomill import sgf_grammar
+
+text_fields = ['bname', 'wname', 'brank', 'wrank', 'bteam', 'wteam',
+               'result', 'date', 'event', 'gname', 'source', 'rules',
+               'overtime', 'user', 'copyright', 'gamecomment', 'komi',
+               'handicap', 'gridsize']
+number_fields = ['date', 'komi', 'handicap', 'gridsize']
+# Query field names that stand for others
+field_aliases = {'black': ['bname'], 'white': ['wname'],
+                 'player': ['bname', 'wname'], 'year': ['date'],
+                 'comments': ['comment'], 'size': ['gridsize']}
+# The field holding every word of a game, for terms without a field
+ANY = ''
+
+comments_cache_filen = './collections/search_comments.json'
+
+_markup_re = re.compile(r'\[/?[a-z]+(=[^\]]*)?\]')
+_word_re = re.compile(r'[^\s,;:()\[\]{}"]+')
+_year_re = re.compile(r'\d{4}')
+_term_re = re.compile(r'(?:(\w+):)?("[^"]*"?|\S+)')
+
+def get_words(text):
+    '''Returns the lower case words of a value, ignoring trailing
+    punctuation and kivy markup, which collections saved by older versions
+    have around the winner's name.'''
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    text = _markup_re.sub(' ', str(text).lower())
+    words = []
+    for word in _word_re.findall(text):
+        word = word.rstrip('.!?\'')
+        if word:
+            words.append(word)
+    return words
+
+def get_number(field, value):
+    '''Returns the number a game info value is compared with in range
+    queries, or None.'''
+    if field == 'date':
+        match = _year_re.search(str(value))
+        if match:
+            return int(match.group())
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def get_comments_from_file(filen):
+    '''Returns the text of every comment in an sgf file, without building
+    its game tree.'''
+    with open(filen, 'r') as fileh:
+        tokens, end = sgf_grammar.tokenise(fileh.read())
+    comments = []
+    in_comment = False
+    for token_type, contents in tokens:
+        if token_type == 'I':
+            in_comment = contents == 'C'
+        elif token_type == 'V':
+            if in_comment:
+                comments.append(sgf_grammar.text_value(contents))
+        else:
+            in_comment = False
+    return '\n'.join(comments)
+
+class SearchQueryError(ValueError):
+    pass
+
+class Term(object):
+    '''One term of a query: a list of fields to look in, and either a
+    list of word prefixes that must all match or a (low, high) range.'''
+    def __init__(self, fields, words=None, low=None, high=None):
+        self.fields = fields
+        self.words = words
+        self.low = low
+        self.high = high
+    def __str__(self):
+        if self.words is None:
+            return 'Term {0} in {1}..{2}'.format(self.fields, self.low, self.high)
+        return 'Term {0} matching {1}'.format(self.fields, self.words)
+    def __repr__(self):
+        return self.__str__()
+
+def parse_query(query):
+    '''Returns the list of Terms of a query string.'''
+    if isinstance(query, unicode):
+        query = query.encode('utf-8')
+    terms = []
+    for field, value in _term_re.findall(query):
+        field = field.lower()
+        if field == '':
+            fields = [ANY]
+        elif field_aliases.has_key(field):
+            fields = field_aliases[field]
+        elif field in text_fields or field == 'comment':
+            fields = [field]
+        else:
+            raise SearchQueryError('Unknown search field ' + field)
+        value = value.strip('"')
+        if '..' in value and field != '':
+            if not all([j in number_fields for j in fields]):
+                raise SearchQueryError('Only {0} can take a range'.format(
+                    ', '.join(number_fields)))
+            low, high = value.split('..', 1)
+            try:
+                low = float(low) if low else None
+                high = float(high) if high else None
+            except ValueError:
+                raise SearchQueryError('Could not read range ' + value)
+            terms.append(Term(fields, low=low, high=high))
+        else:
+            words = get_words(value)
+            if words:
+                terms.append(Term(fields, words=words))
+    return terms
+
+class SearchIndex(object):
+    '''Maps the words of each game info field to the set of ids of the
+    games containing them. Word lists are sorted lazily on first use after
+    a change, so a prefix is a binary search, and numbers are kept sorted
+    the same way for range queries.'''
+    def __init__(self):
+        self.built = False
+        self.with_comments = False
+        self.next_id = 0
+        self.games = {}
+        self.ids = {}
+        # field -> word -> set of game ids
+        self.postings = {}
+        # game id -> list of (field, word) and (field, number), for removal
+        self.game_words = {}
+        self.game_numbers = {}
+        # field -> game id -> number
+        self.numbers = {}
+        self.sorted_words = {}
+        self.sorted_numbers = {}
+        # sgf filename -> [mtime, comment words]
+        self.comments_cache = {}
+        self.comments_cache_changed = False
+    def __str__(self):
+        return 'SearchIndex of {0} games, {1} words'.format(
+            len(self.games), len(self.postings.get(ANY, {})))
+    def __repr__(self):
+        return self.__str__()
+
+    def build(self, collections, with_comments=False):
+        '''Indexes every game of the given collections, replacing anything
+        indexed before. Comment words are read from the sgf files, and
+        cached on disk by file mtime.'''
+        self.__init__()
+        self.with_comments = with_comments
+        if with_comments:
+            self.load_comments_cache()
+        for collection in collections:
+            collection.finish_lazy_loading()
+            for game in collection.games:
+                self.add_game(game)
+        self.built = True
+        if self.comments_cache_changed:
+            self.save_comments_cache()
+        return self
+
+    def add_game(self, collectionsgf):
+        game_id = self.next_id
+        self.next_id += 1
+        self.games[game_id] = collectionsgf
+        self.ids[collectionsgf] = game_id
+        words = set()
+        numbers = []
+        info = collectionsgf.gameinfo
+        for field in text_fields:
+            if not info.has_key(field):
+                continue
+            value = info[field]
+            for word in get_words(value):
+                words.add((field, word))
+                words.add((ANY, word))
+            if field in number_fields:
+                number = get_number(field, value)
+                if number is not None:
+                    numbers.append((field, number))
+        if self.with_comments:
+            for word in self.get_comment_words(collectionsgf.filen):
+                words.add(('comment', word))
+                words.add((ANY, word))
+        for field, word in words:
+            field_postings = self.postings.setdefault(field, {})
+            if not field_postings.has_key(word):
+                field_postings[word] = set()
+                self.sorted_words.pop(field, None)
+            field_postings[word].add(game_id)
+        for field, number in numbers:
+            self.numbers.setdefault(field, {})[game_id] = number
+            self.sorted_numbers.pop(field, None)
+        self.game_words[game_id] = words
+        self.game_numbers[game_id] = numbers
+        return game_id
+
+    def remove_game(self, collectionsgf):
+        '''Removes a game from the index, if it is indexed.'''
+        game_id = self.ids.pop(collectionsgf, None)
+        if game_id is None:
+            return
+        del self.games[game_id]
+        for field, word in self.game_words.pop(game_id):
+            field_postings = self.postings[field]
+            field_postings[word].discard(game_id)
+            if len(field_postings[word]) == 0:
+                del field_postings[word]
+                self.sorted_words.pop(field, None)
+        for field, number in self.game_numbers.pop(game_id):
+            del self.numbers[field][game_id]
+            self.sorted_numbers.pop(field, None)
+
+    def update_game(self, collectionsgf):
+        '''Reindexes a game whose info has changed. Does nothing until the
+        index has been built, as build will see the change.'''
+        if not self.built:
+            return
+        self.remove_game(collectionsgf)
+        self.add_game(collectionsgf)
+        if self.comments_cache_changed:
+            self.save_comments_cache()
+
+    def get_comment_words(self, filen):
+        try:
+            mtime = getmtime(filen)
+        except OSError:
+            return []
+        cached = self.comments_cache.get(filen)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        try:
+            words = sorted(set(get_words(get_comments_from_file(filen))))
+        except IOError:
+            words = []
+        self.comments_cache[filen] = [mtime, words]
+        self.comments_cache_changed = True
+        return words
+
+    def load_comments_cache(self):
+        if not exists(comments_cache_filen):
+            return
+        try:
+            with open(comments_cache_filen, 'r') as fileh:
+                cache = json.load(fileh)
+        except (IOError, ValueError):
+            print 'Comment search cache unreadable, rebuilding'
+            return
+        for filen, (mtime, words) in cache.iteritems():
+            self.comments_cache[filen.encode('utf-8')] = [
+                mtime, [word.encode('utf-8') for word in words]]
+
+    def save_comments_cache(self):
+        try:
+            with open(comments_cache_filen, 'w') as fileh:
+                json.dump(self.comments_cache, fileh)
+            self.comments_cache_changed = False
+        except IOError:
+            print 'Could not save comment search cache'
+
+    def get_sorted_words(self, field):
+        if not self.sorted_words.has_key(field):
+            self.sorted_words[field] = sorted(self.postings.get(field, {}).keys())
+        return self.sorted_words[field]
+
+    def get_sorted_numbers(self, field):
+        if not self.sorted_numbers.has_key(field):
+            self.sorted_numbers[field] = sorted(
+                [(number, game_id) for game_id, number
+                 in self.numbers.get(field, {}).iteritems()])
+        return self.sorted_numbers[field]
+
+    def match_prefix(self, field, prefix):
+        '''Returns the set of ids of games with a word starting with
+        prefix in the field.'''
+        field_postings = self.postings.get(field, {})
+        words = self.get_sorted_words(field)
+        matches = set()
+        i = bisect_left(words, prefix)
+        while i < len(words) and words[i].startswith(prefix):
+            matches.update(field_postings[words[i]])
+            i += 1
+        return matches
+
+    def match_range(self, field, low, high):
+        numbers = self.get_sorted_numbers(field)
+        start = 0
+        end = len(numbers)
+        if low is not None:
+            start = bisect_left(numbers, (low, -1))
+        if high is not None:
+            end = bisect_right(numbers, (high, self.next_id))
+        return set([game_id for number, game_id in numbers[start:end]])
+
+    def match_term(self, term):
+        matches = set()
+        for field in term.fields:
+            if term.words is None:
+                matches.update(self.match_range(field, term.low, term.high))
+                continue
+            field_matches = None
+            for word in term.words:
+                word_matches = self.match_prefix(field, word)
+                if field_matches is None:
+                    field_matches = word_matches
+                else:
+                    field_matches &= word_matches
+                if not field_matches:
+                    break
+            matches.update(field_matches)
+        return matches
+
+    def search(self, query):
+        '''Returns the list of collectionsgfs matching a query string,
+        ordered by date. Raises SearchQueryError if the query can't be
+        read.'''
+        terms = parse_query(query)
+        if not terms:
+            return []
+        matches = None
+        for term in terms:
+            term_matches = self.match_term(term)
+            if matches is None:
+                matches = term_matches
+            else:
+                matches &= term_matches
+            if not matches:
+                return []
+        games = [self.games[game_id] for game_id in matches]
+        return sorted(games, key=lambda j: str(j.gameinfo.get('date', '')))
+
+search_index = SearchIndex()
+
+if __name__ == '__main__':
+    import sys
+    from time import time
+    from sgfcollections import CollectionsList
+    collections = CollectionsList().from_file()
+    t1 = time()
+    search_index.build(collections.collections, with_comments=True)
+    print 'built', search_index, 'in', time()-t1
+    query = ' '.join(sys.argv[1:]) or 'bname:Shusaku result:W+ date:1850..1860'
+    t1 = time()
+    results = search_index.search(query)
+    print len(results), 'games match', query, 'in', time()-t1
+    for game in results[:20]:
+        print game.filen
@@ -15,19 +15,73 @@ from kivy.properties import NumericProperty, ReferenceListProperty, ObjectProper
 from kivy.app import App
 from kivy.event import EventDispatcher
 from kivy.utils import platform
+from kivy.clock import Clock
 
-from helpers import embolden
+from helpers import embolden, write_atomically
+from mylistview import ListModel
 
 from glob import glob
 from os import mkdir
 import os
+import sys
+import re
 import json
 import time
 import shutil
 import random
+import threading
+from functools import partial
+from bisect import bisect_left, insort
 
-SERIALISATION_VERSION = 2
+SERIALISATION_VERSION = 3
+# Seconds without changes before a collection's journal is compacted
+COMPACT_DELAY = 10
 
+def get_journal_filen(filen):
+    '''Returns the journal filename of a collection json file.'''
+    if filen.endswith('.json'):
+        filen = filen[:-5]
+    return filen + '.journal'
+
+def read_journal(filen):
+    '''Returns the list of ops in a journal file, skipping any line left
+    partly written by a crash.'''
+    ops = []
+    try:
+        with open(filen,'r') as fileh:
+            for line in fileh:
+                try:
+                    ops.append(jsonconvert(json.loads(line)))
+                except ValueError:
+                    print 'Skipping partly written journal line in',filen
+    except IOError:
+        pass
+    return ops
+
+def apply_journal(games,ops):
+    '''Applies journal ops to a list of [filen, can_change_name, gameinfo]
+    game records, returning the new list. An op is ['put', key, record],
+    replacing the record saved with filename key, or adding it, or
+    ['remove', key]. Ops already in the records are harmless, so a
+    journal may be replayed over a file it was compacted into.'''
+    games = list(games)
+    positions = dict([(record[0], i) for i, record in enumerate(games)])
+    for op in ops:
+        kind, key = op[0], op[1]
+        i = positions.pop(key,None)
+        if kind == 'put':
+            record = op[2]
+            if i is None:
+                i = positions.pop(record[0],None)
+            if i is None:
+                i = len(games)
+                games.append(record)
+            else:
+                games[i] = record
+            positions[record[0]] = i
+        elif kind == 'remove' and i is not None:
+            games[i] = None
+    return filter(lambda j: j is not None,games)
 
 def get_collectioninfo_from_dir(row_index,dirn):
     sgfs = glob(dirn + '/*.sgf')
@@ -54,6 +108,16 @@ class StandaloneGameChooser(BoxLayout):
     managedby = ObjectProperty(None,allownone=True)
     gameslist = ObjectProperty()
     collection = ObjectProperty(None,allownone=True)
+    view = ObjectProperty(None,allownone=True)
+    def set_sort(self,text):
+        if self.view is not None:
+            self.view.sort_by = text.lower()
+    def set_reverse(self,state):
+        if self.view is not None:
+            self.view.reverse = state == 'down'
+    def set_filter(self,text):
+        if self.view is not None:
+            self.view.filter_text = text
     # def populate_from_directory(self,dir):
     #     sgfs = glob(''.join((dir,'/*.sgf')))
     #     print 'sgfs found in directory: ',sgfs
@@ -95,6 +159,38 @@ class GameChooserButton(ListItemButton):
     def construct_from_sgfinfo(self,info):
         self.info.construct_from_sgfinfo(info)
 
+class PositionResultButton(GameChooserButton):
+    movenumber = NumericProperty(0)
+
+def get_position_result_info(row_index,result):
+    collectionsgf, movenumber = result
+    info = dict(collectionsgf.info_for_button())
+    info['movenumber'] = movenumber
+    info['date'] = 'Move {0}, {1}'.format(movenumber,info.get('date','---'))
+    return info
+
+class GameSearch(BoxLayout):
+    '''A query box and the list of games matching it.'''
+    results_list = ObjectProperty(None,allownone=True)
+    popup = ObjectProperty(None,allownone=True)
+    status = StringProperty('e.g. bname:Shusaku result:W+ date:1850..1860')
+    def __init__(self,*args,**kwargs):
+        self.results = ListModel()
+        super(GameSearch,self).__init__(*args,**kwargs)
+    def search(self,query):
+        # Search is imported on first use, to keep it out of startup
+        from searchindex import search_index, SearchQueryError
+        t1 = time.time()
+        try:
+            results = search_index.search(query)
+        except SearchQueryError as e:
+            self.status = str(e)
+            results = []
+        else:
+            self.status = '{0} games'.format(len(results))
+        print 'search for',query,'found',len(results),'games in',time.time()-t1
+        self.results.reset(results)
+
 class GameChooserInfo(BoxLayout):
     owner = ObjectProperty('')
     filepath = StringProperty('')
@@ -137,7 +233,12 @@ class GameChooserInfo(BoxLayout):
 
 class CollectionsList(EventDispatcher):
     collections = ListProperty([])
-    popup = ObjectProperty(None,allownone=True)
+    loading = BooleanProperty(False)
+    progress = NumericProperty(0)
+    length = NumericProperty(1)
+    def __init__(self,*args,**kwargs):
+        self.pending_collections = []
+        super(CollectionsList,self).__init__(*args,**kwargs)
     def __str__(self):
         return 'CollectionsList with {0} collections'.format(len(self.collections))
     def __repr__(self):
@@ -159,7 +260,7 @@ class CollectionsList(EventDispatcher):
     def serialise(self):
         coll_lists = [SERIALISATION_VERSION,map(lambda j: j.get_filen(),self.collections)]
         return json.dumps(coll_lists)
-    def from_file(self,filen='default'):
+    def read_list(self,filen='default'):
         #default_filen = App.get_running_app().user_data_dir + '/collections_list.json'
         default_filen = './collections/collections_list.json'
         if filen == 'default':
@@ -168,6 +269,17 @@ class CollectionsList(EventDispatcher):
             colstr = fileh.read()
         version,colpy = json.loads(colstr)
         colpy = jsonconvert(colpy)
+        if version in [2,3]:
+            entries = []
+            for entry in colpy:
+                parts = entry.split('/')
+                if len(parts) == 2:
+                    entry = './collections/' + parts[-1]
+                entries.append(entry)
+            colpy = entries
+        return version,colpy
+    def from_file(self,filen='default'):
+        version,colpy = self.read_list(filen)
         if version == 1:
             for entry in colpy:
                 col = Collection()
@@ -176,29 +288,68 @@ class CollectionsList(EventDispatcher):
                 for game in entry[2]:
                     col.games.append(CollectionSgf().from_dict(game,col))
                 self.collections.append(col)
-        elif version == 2:
-            if self.popup is not None:
-                self.popup.progress = 0
-                self.popup.length = len(colpy)
-            for entry in colpy:
-                parts = entry.split('/')
-                if len(parts) == 2:
-                    # print 'REBUILDING ENTRY'
-                    # print 'entry is',entry
-                    entry = './collections/' + parts[-1] # 
-                    # print 'now is',entry
-                try:
-                    col = Collection().from_file(entry)
-                    self.collections.append(col)
-                    if self.popup is not None:
-                        # print 'popup is',self.popup, self.popup.progress, self.popup.length
-                        self.popup.progress += 1
-                       # time.sleep(1)
-                except IOError:
-                    print 'Collection doesn\'t seem to exist. Skipping.'
+        elif version in [2,3]:
+            self.start_loading(colpy)
+            self.finish_loading()
         else:
             print 'Collection list version not recognised.'
         return self
+    def load_in_background(self,filen='default'):
+        '''Loads the collections on a worker thread. Each collection file
+        is read and decoded there, and the Collection is made on the main
+        thread, so collections appear one by one.'''
+        try:
+            version,colpy = self.read_list(filen)
+        except IOError:
+            print 'No collections list found.'
+            return self
+        if version not in [2,3]:
+            return self.from_file(filen)
+        self.start_loading(colpy)
+        thread = threading.Thread(target=self.background_load,args=(colpy,))
+        thread.daemon = True
+        thread.start()
+        return self
+    def start_loading(self,entries):
+        self.pending_collections = list(entries)
+        self.loading = len(entries) > 0
+        self.length = len(entries)
+        self.progress = 0
+    def background_load(self,entries):
+        for entry in entries:
+            if not self.loading:
+                break
+            try:
+                data = read_collection_file(entry)
+            except IOError:
+                data = None
+            Clock.schedule_once(partial(self.add_collection,entry,data))
+    def add_collection(self,entry,data,*args):
+        '''Adds a collection read by read_collection_file, or skips it if
+        data is None. Ignores collections already added by
+        finish_loading.'''
+        if entry not in self.pending_collections:
+            return
+        self.pending_collections.remove(entry)
+        if data is None:
+            print 'Collection doesn\'t seem to exist. Skipping.'
+        else:
+            self.collections.append(Collection().from_data(*data))
+        self.progress += 1
+        if len(self.pending_collections) == 0:
+            self.loading = False
+    def finish_loading(self):
+        '''Synchronously loads any collections not yet loaded.'''
+        for entry in list(self.pending_collections):
+            try:
+                data = read_collection_file(entry)
+            except IOError:
+                data = None
+            self.add_collection(entry,data)
+    def compact(self):
+        '''Compacts the journal of every collection with changes.'''
+        for collection in self.collections:
+            collection.compact()
     def new_collection(self,newname):
         if platform() == 'android':
             dirn = '/sdcard/noGo/collections/{0}'.format(newname)
@@ -218,18 +369,216 @@ class CollectionsList(EventDispatcher):
         matching_collections = filter(lambda j: j.name == name,self.collections)
         for col in matching_collections:
             self.collections.remove(col)
+            search_index = get_loaded_search_index()
+            if search_index is not None:
+                for game in col.games:
+                    search_index.remove_game(game)
+
+sort_options = ['added','date','black','white','rank','result']
+
+def get_loaded_search_index():
+    '''Returns the search index if searchindex has been imported, or
+    None. An index that was never imported hasn't been built, so has
+    nothing to keep up to date.'''
+    if sys.modules.has_key('searchindex'):
+        return sys.modules['searchindex'].search_index
+    return None
+
+def strip_markup(s):
+    return s.replace('[b]','').replace('[/b]','')
+
+def get_rank_value(rank):
+    '''Returns a number that increases with strength for ranks like 9p,
+    3d, 3 dan or 15k, or None if the rank can't be read.'''
+    match = re.match(r'\s*(\d+)\s*-?\s*([pdk])',rank.lower())
+    if match is None:
+        return None
+    number = int(match.group(1))
+    kind = match.group(2)
+    if kind == 'p':
+        return 100 + number
+    elif kind == 'd':
+        return 50 + number
+    return 50 - number
+
+def get_result_value(result):
+    '''Returns a key sorting results by winner, then by margin with wins
+    by resignation or time after wins on points.'''
+    winner, sep, margin = result.upper().partition('+')
+    winner = {'B':0,'W':1}.get(winner.strip(),2)
+    if margin[:1] in ['R','T','F']:
+        margin = 1000.
+    else:
+        try:
+            margin = float(margin)
+        except ValueError:
+            margin = 0.
+    return (winner, margin)
+
+def get_sort_keys(info):
+    '''Returns a dict of the sort key for each of sort_options, with
+    games missing a value sorting last, and the lower case text that
+    filters match.'''
+    bname = strip_markup(str(info.get('bname','')))
+    wname = strip_markup(str(info.get('wname','')))
+    date = str(info.get('date',''))
+    result = str(info.get('result',''))
+    ranks = filter(lambda j: j is not None,
+                   [get_rank_value(str(info.get('brank',''))),
+                    get_rank_value(str(info.get('wrank','')))])
+    keys = {'date': (date == '', date),
+            'black': (bname == '', bname.lower()),
+            'white': (wname == '', wname.lower()),
+            # The strongest player's rank, strongest first
+            'rank': (len(ranks) == 0, -1*max(ranks) if ranks else 0),
+            'result': (result == '', get_result_value(result)),
+            }
+    keys['text'] = ' '.join([bname, wname, date, result,
+                             str(info.get('event','')),
+                             str(info.get('brank','')),
+                             str(info.get('wrank',''))]).lower()
+    return keys
+
+class CollectionView(EventDispatcher):
+    '''A sorted and filtered view of a collection's games, held in the
+    ListModel model.
+
+    Each game's sort keys are computed once from its gameinfo, and games
+    added to, removed from or changed in the collection are moved in
+    place, so neither resorting nor refreshing reads any files or calls
+    info_for_button. Only the rows that moved or changed are redrawn.'''
+    collection = ObjectProperty(None,allownone=True)
+    sort_by = OptionProperty('added',options=sort_options)
+    reverse = BooleanProperty(False)
+    filter_text = StringProperty('')
+    def __init__(self,*args,**kwargs):
+        # game -> sort keys, and game -> the order it was first seen in
+        self.keys = {}
+        self.seqs = {}
+        self.next_seq = 0
+        # (key, seq, game) for every game, sorted
+        self.entries = []
+        self.model = ListModel()
+        super(CollectionView,self).__init__(*args,**kwargs)
+        self.bind(sort_by=self.resort,
+                  reverse=self.apply,
+                  filter_text=self.apply)
+        self.collection.bind(games=self.games_changed,
+                             on_game_changed=self.game_changed)
+        self.resort()
+    def __str__(self):
+        return 'CollectionView of {0} by {1}, {2} of {3} games shown'.format(
+            self.collection.name,self.sort_by,len(self.model),len(self.entries))
+    def __repr__(self):
+        return self.__str__()
+    def get_entry(self,game):
+        seq = self.seqs[game]
+        if self.sort_by == 'added':
+            return (seq, seq, game)
+        return (self.keys[game][self.sort_by], seq, game)
+    def add_keys(self,game):
+        self.keys[game] = get_sort_keys(game.gameinfo)
+        if not self.seqs.has_key(game):
+            self.seqs[game] = self.next_seq
+            self.next_seq += 1
+    def remove_entry(self,game):
+        entry = self.get_entry(game)
+        i = bisect_left(self.entries,entry)
+        if i < len(self.entries) and self.entries[i][2] is game:
+            self.entries.pop(i)
+    def resort(self,*args):
+        for game in self.collection.games:
+            if not self.keys.has_key(game):
+                self.add_keys(game)
+        self.entries = sorted([self.get_entry(game) for game in self.collection.games])
+        self.apply()
+    def games_changed(self,collection,games):
+        '''Moves in the games added to or removed from the collection.'''
+        current = set(games)
+        removed = filter(lambda j: j not in current,self.keys.keys())
+        added = filter(lambda j: not self.keys.has_key(j),games)
+        if len(removed) + len(added) > len(games) // 2:
+            for game in removed:
+                self.keys.pop(game)
+                self.seqs.pop(game)
+            return self.resort()
+        for game in removed:
+            self.remove_entry(game)
+            self.keys.pop(game)
+            self.seqs.pop(game)
+        for game in added:
+            self.add_keys(game)
+            insort(self.entries,self.get_entry(game))
+        self.apply()
+    def game_changed(self,collection,game):
+        if self.update_game(game):
+            self.apply(changed=[game])
+        else:
+            self.model.update(game)
+    def update_game(self,game):
+        '''Moves a game whose gameinfo has changed, returning True if its
+        keys changed.'''
+        if not self.keys.has_key(game):
+            return False
+        keys = get_sort_keys(game.gameinfo)
+        if keys == self.keys[game]:
+            return False
+        self.remove_entry(game)
+        self.keys[game] = keys
+        insort(self.entries,self.get_entry(game))
+        return True
+    def refresh(self):
+        '''Checks every game's keys against its gameinfo, and updates the
+        games shown if any have changed.'''
+        changed = filter(self.update_game,self.collection.games)
+        if changed:
+            self.apply(changed=changed)
+    def apply(self,*args,**kwargs):
+        words = self.filter_text.lower().split()
+        keys = self.keys
+        if words:
+            games = [entry[2] for entry in self.entries
+                     if all([word in keys[entry[2]]['text'] for word in words])]
+        else:
+            games = [entry[2] for entry in self.entries]
+        if self.reverse:
+            games.reverse()
+        self.model.set_rows(games)
+        # Changed games that didn't move must still be redrawn
+        for game in kwargs.get('changed',[]):
+            self.model.update(game)
 
 def get_collectioninfo_from_collection(row_index,col):
     return {'colname': col.name, 'numentries': col.number_of_games(), 'collection': col}
 
+def read_collection_file(filen):
+    '''Returns the (version, data) of a collection file, with any changes
+    in its journal applied, and whether there were any. Safe to call from
+    a worker thread.'''
+    with open(filen,'r') as fileh:
+        jsonstr = fileh.read()
+    version,selflist = json.loads(jsonstr)
+    selflist = jsonconvert(selflist)
+    ops = read_journal(get_journal_filen(filen))
+    if ops and version == SERIALISATION_VERSION:
+        name, defaultdir, games = selflist
+        selflist = [name, defaultdir, apply_journal(games,ops)]
+    return version,selflist,len(ops) > 0
+
 class Collection(EventDispatcher):
+    '''Fires on_game_changed(collectionsgf) when a game's info is
+    changed.'''
+    __events__ = ('on_game_changed',)
     games = ListProperty([])
     lazy_games = ListProperty([])
     name = StringProperty('Collection')
     defaultdir = StringProperty('./games/unsaved/')
     lazy_loaded = BooleanProperty(False)
     finished_loading = BooleanProperty(False)
+    loading = BooleanProperty(False)
     def __init__(self,*args,**kwargs):
+        self.pending_games = set()
+        self.journal_changed = False
         if platform() == 'android':
             self.defaultdir = '/sdcard/noGo/collections/unsaved/'
         super(Collection,self).__init__(*args,**kwargs)
@@ -237,39 +586,143 @@ class Collection(EventDispatcher):
         return 'SGF collection {0} with {1} games'.format(self.name,self.number_of_games())
     def __repr__(self):
         return self.__str__()
+    def on_game_changed(self,collectionsgf):
+        pass
+    def save_game(self,game):
+        '''Records a game's changed info or filename in the journal, and
+        schedules the journal to be compacted into the collection file.'''
+        if self.lazy_loaded and not self.finished_loading:
+            # The journal only applies to current format files, so
+            # migrate the collection now
+            return self.save()
+        self.append_to_journal(['put',game.saved_filen,game.to_dict()])
+        game.saved_filen = game.filen
+    def append_to_journal(self,op):
+        with open(self.get_journal_filen(),'a+') as fileh:
+            fileh.seek(0,2)
+            if fileh.tell() > 0:
+                # Don't continue a line left partly written by a crash
+                fileh.seek(-1,2)
+                last = fileh.read(1)
+                fileh.seek(0,2)
+                if last != '\n':
+                    fileh.write('\n')
+            fileh.write(json.dumps(op) + '\n')
+            fileh.flush()
+            os.fsync(fileh.fileno())
+        self.journal_changed = True
+        Clock.unschedule(self.compact)
+        Clock.schedule_once(self.compact,COMPACT_DELAY)
+    def compact(self,*args):
+        '''Writes the collection file and removes the journal, if there
+        have been changes since the last compaction.'''
+        Clock.unschedule(self.compact)
+        if self.journal_changed:
+            print 'Compacting journal of',self.name
+            self.save()
     def remove_sgf(self,sgf):
-        self.finish_lazy_loading()
+        # Games not loaded yet have no CollectionSgf to remove
         if sgf in self.games:
             self.games.remove(sgf)
+            if self.lazy_loaded and not self.finished_loading:
+                self.save()
+            else:
+                self.append_to_journal(['remove',sgf.saved_filen])
+        search_index = get_loaded_search_index()
+        if search_index is not None:
+            search_index.remove_game(sgf)
     def get_default_dir(self):
         return '.' + '/' + self.name
     def number_of_games(self):
-        if not self.finished_loading:
-            return len(self.lazy_games)
+        if self.lazy_loaded and not self.finished_loading:
+            return len(self.games) + len(self.lazy_games)
         else:
             return len(self.games)
     def lazy_from_list(self, l):
+        '''Loads a SERIALISATION_VERSION 2 collection, whose games are
+        stored in one sidecar file each. These are only read when
+        needed, and the collection is then resaved in the current
+        format.'''
         name, defaultdir, games = l
         self.name = name
         self.defaultdir = defaultdir
         self.lazy_games = games
+        self.pending_games = set(games)
         self.lazy_loaded = True
         self.finished_loading = False
         return self
-    def finish_lazy_loading(self):
-        print 'Finishing lazy loading'
-        if not self.finished_loading and self.lazy_loaded:
-            print 'need to load',len(self.lazy_games)
-            for game in self.lazy_games:
-                print 'currently doing',game
-                try:
-                    colsgf = CollectionSgf(collection=self).load(game)
-                    self.games.append(colsgf)
-                except IOError:
-                    print '(lazy) Tried to load sgf that doesn\'t seem to exist. Skipping.'
-                    print 'game was', game
-            self.lazy_games = []
+    def load_lazy_games(self,filens):
+        '''Reads the sidecar files of some lazy games, returning a list of
+        (filen, collectionsgf), with None for files that couldn't be
+        read. Safe to call from a worker thread.'''
+        loaded = []
+        for filen in filens:
+            try:
+                colsgf = CollectionSgf(collection=self).load(filen)
+            except IOError:
+                print '(lazy) Tried to load sgf that doesn\'t seem to exist. Skipping.'
+                print 'game was', filen
+                colsgf = None
+            loaded.append((filen,colsgf))
+        return loaded
+    def add_lazy_games(self,loaded,*args):
+        '''Adds loaded games to the collection, and resaves it in the
+        current format once every game has been added.'''
+        if self.add_loaded_games(loaded):
+            print 'Migrating collection',self.name,'to a single file'
+            self.save()
+    def add_loaded_games(self,loaded):
+        '''Adds loaded games to the collection, ignoring any that were
+        already added by another route. Returns True if this finished
+        loading the collection.'''
+        loaded = filter(lambda j: j[0] in self.pending_games,loaded)
+        if len(loaded) == 0:
+            return False
+        for filen, colsgf in loaded:
+            self.pending_games.remove(filen)
+        self.lazy_games = filter(lambda j: j in self.pending_games,self.lazy_games)
+        games = filter(lambda j: j is not None,map(lambda j: j[1],loaded))
+        self.games.extend(games)
+        search_index = get_loaded_search_index()
+        if search_index is not None:
+            for game in games:
+                search_index.update_game(game)
+        if len(self.pending_games) == 0:
+            self.loading = False
             self.finished_loading = True
+            return True
+        return False
+    def load_in_background(self,page_size=25):
+        '''Loads a lazy collection's games a page at a time. The first page
+        is loaded immediately, and the rest on a worker thread, with each
+        page added to games on the main thread as it arrives.'''
+        if self.finished_loading or not self.lazy_loaded or self.loading:
+            return
+        self.loading = True
+        self.add_lazy_games(self.load_lazy_games(self.lazy_games[:page_size]))
+        if self.finished_loading:
+            return
+        filens = list(self.lazy_games)
+        thread = threading.Thread(target=self.background_load,args=(filens,page_size))
+        thread.daemon = True
+        thread.start()
+    def background_load(self,filens,page_size):
+        for start in range(0,len(filens),page_size):
+            if self.finished_loading:
+                break
+            loaded = self.load_lazy_games(filens[start:start+page_size])
+            Clock.schedule_once(partial(self.add_lazy_games,loaded))
+    def finish_lazy_loading(self,migrate=True):
+        '''Loads every remaining lazy game. The collection is resaved in
+        the current format unless migrate is False, as when it is
+        about to be saved anyway.'''
+        if not self.finished_loading and self.lazy_loaded:
+            print 'Finishing lazy loading, need to load',len(self.lazy_games)
+            loaded = self.load_lazy_games(self.lazy_games)
+            if migrate:
+                self.add_lazy_games(loaded)
+            else:
+                self.add_loaded_games(loaded)
     def from_list(self,l):
         name,defaultdir,games = l
         self.name = name
@@ -284,54 +737,118 @@ class Collection(EventDispatcher):
                 print 'game was', game
         #self.games = map(lambda j: CollectionSgf(collection=self).load(j),games)
         return self
+    def from_game_list(self, l):
+        '''Loads a collection whose games' info is stored in the same
+        file, as written by as_list.'''
+        name, defaultdir, games = l
+        self.name = name
+        self.defaultdir = defaultdir
+        self.games = [CollectionSgf(collection=self).from_dict(game) for game in games]
+        self.lazy_loaded = False
+        self.finished_loading = True
+        return self
     def as_list(self):
-        self.finish_lazy_loading()
-        return [self.name, self.defaultdir, map(lambda j: j.get_filen(),self.games)]
+        self.finish_lazy_loading(migrate=False)
+        return [self.name, self.defaultdir, map(lambda j: j.to_dict(),self.games)]
     def serialise(self):
-        self.finish_lazy_loading()
+        self.finish_lazy_loading(migrate=False)
         return json.dumps([SERIALISATION_VERSION,self.as_list()])
     def save(self):
-        self.finish_lazy_loading()
+        '''Writes the whole collection file, folding in and removing the
+        journal. Changes to single games should use save_game.'''
+        self.finish_lazy_loading(migrate=False)
         if platform() == 'android':
             filen = '/sdcard/noGo/' + self.name + '.json'
         else:
             filen = '.' + '/collections/' + self.name + '.json'
-        with open(filen,'w') as fileh:
-            fileh.write(self.serialise())
+        write_atomically(filen,self.serialise())
+        for game in self.games:
+            game.saved_filen = game.filen
+        journal_filen = self.get_journal_filen()
+        if os.path.exists(journal_filen):
+            os.remove(journal_filen)
+        self.journal_changed = False
         return filen
     def get_filen(self):
         filen = '.' + '/collections/' + self.name + '.json'
         return filen
+    def get_journal_filen(self):
+        return get_journal_filen(self.get_filen())
     def from_file(self,filen):
-        # print 'Trying to load collection from',filen
-        with open(filen,'r') as fileh:
-            jsonstr = fileh.read()
-        #print 'File contents are',jsonstr
-        version,selflist = json.loads(jsonstr)
-        selflist = jsonconvert(selflist)
-        return self.lazy_from_list(selflist)
+        return self.from_data(*read_collection_file(filen))
+    def from_data(self,version,selflist,journalled=False):
+        if version == 2:
+            return self.lazy_from_list(selflist)
+        self.from_game_list(selflist)
+        if journalled:
+            # Fold the replayed journal into the file once things are quiet
+            self.journal_changed = True
+            Clock.schedule_once(self.compact,COMPACT_DELAY)
+        return self
     def add_game(self,can_change_name=True):
         self.finish_lazy_loading()
         game = CollectionSgf(collection=self,can_change_name=can_change_name)
         game.filen = game.get_default_filen() + '.sgf'
         self.games.append(game)
-        self.save()
+        self.save_game(game)
         return game
     def random_sgf(self):
-        self.finish_lazy_loading()
+        index = random.randrange(self.number_of_games())
+        if index < len(self.games):
+            return self.games[index]
+        # Load just the chosen game
+        loaded = self.load_lazy_games([self.lazy_games[index-len(self.games)]])
+        self.add_lazy_games(loaded)
+        if loaded[0][1] is not None:
+            return loaded[0][1]
         return random.choice(self.games)
 
 
 
+display_fields = ['bname','wname','brank','wrank','result','date']
+
+class DisplayInfo(dict):
+    '''The fields a game's list rows show, as returned by
+    CollectionSgf.info_for_button. One DisplayInfo is shared by every row
+    showing the game, so it can't be changed; use dict(info) for a copy
+    to change.'''
+    def _immutable(self,*args,**kwargs):
+        raise TypeError('DisplayInfo can\'t be changed')
+    __setitem__ = _immutable
+    __delitem__ = _immutable
+    clear = _immutable
+    pop = _immutable
+    popitem = _immutable
+    setdefault = _immutable
+    update = _immutable
+
+def get_display_info(collectionsgf):
+    info = {}
+    gameinfo = collectionsgf.gameinfo
+    for field in display_fields:
+        if field in gameinfo:
+            info[field] = str(gameinfo[field])
+    winner = info.get('result','')[:1]
+    if winner in ['B','b'] and 'bname' in info:
+        info['bname'] = embolden(info['bname'])
+    elif winner in ['W','w'] and 'wname' in info:
+        info['wname'] = embolden(info['wname'])
+    info['collection'] = collectionsgf.collection
+    info['filepath'] = collectionsgf.filen
+    info['collectionsgf'] = collectionsgf
+    return DisplayInfo(info)
+
 class CollectionSgf(object):
     def __init__(self,collection=None, can_change_name=True, filen=''):
         self.gameinfo = {}
+        self.display_info = None
         self.collection = collection
         self.can_change_name = can_change_name # Indicates whether the filename should be changed when game info does
         self.filen = filen
+        # The filename the game has in the collection file and journal
+        self.saved_filen = filen
     def delete(self):
         self.collection.remove_sgf(self)
-        self.collection.save()
     def get_default_filen(self):
         #print 'asked for default filen',self.collection
         if self.collection is not None:
@@ -339,34 +856,22 @@ class CollectionSgf(object):
     def from_dict(self,info,collection=None):
         filen,can_change_name,gameinfo = info
         self.filen = filen
+        self.saved_filen = filen
         self.can_change_name = can_change_name
         self.gameinfo = gameinfo
+        self.display_info = None
         if collection is not None:
             self.collection = collection
         return self
     def to_dict(self):
-        gi = self.gameinfo
-        try:
-            gi.pop('collection')
-        except KeyError:
-            pass
-        try:
-            gi.pop('collectionsgf')
-        except KeyError:
-            pass
-        return [self.filen,self.can_change_name,gi]
-    def serialise(self):
-        return json.dumps([SERIALISATION_VERSION,self.to_dict()])
+        return [self.filen,self.can_change_name,self.gameinfo]
     def save(self):
-        dict = self.to_dict()
-        filen = self.filen + '.json'
-        with open(filen,'w') as fileh:
-            fileh.write(self.serialise())
-        return filen
-    def get_filen(self):
-        filen = self.filen + '.json'
-        return filen
+        '''Game info is stored with the rest of the collection, so this
+        records the game in the collection's journal.'''
+        if self.collection is not None:
+            return self.collection.save_game(self)
     def load(self,filen):
+        '''Loads from a SERIALISATION_VERSION 2 sidecar file.'''
         #print 'Trying to load collectionsgf from',filen
         with open(filen,'r') as fileh:
             jsonstr = fileh.read()
@@ -381,6 +886,7 @@ class CollectionSgf(object):
         return self
     def set_gameinfo(self,info,resave=True):
         self.gameinfo = info
+        self.display_info = None
         if self.can_change_name:
             oldn = self.filen
             gamestr = ''
@@ -393,13 +899,18 @@ class CollectionSgf(object):
             if gamestr not in self.filen:
                 newn = self.get_default_filen() + gamestr + '.sgf'
                 self.filen = newn
-                self.collection.save()
+                self.save()
                 #App.get_running_app().collections.save()
                 try:
                     shutil.copyfile(oldn,newn)
                     os.remove(oldn)
                 except IOError:
                     print 'Tried to copy file that doesn\'t exist',oldn,newn
+        search_index = get_loaded_search_index()
+        if search_index is not None:
+            search_index.update_game(self)
+        if self.collection is not None:
+            self.collection.dispatch('on_game_changed',self)
         #App.get_running_app().collections.save()
     def set_filen(self,filen=''):
         if filen == '':
@@ -416,25 +927,19 @@ class CollectionSgf(object):
                 if gamestr not in self.filen:
                     newn = self.get_default_filen() + gamestr + '.sgf'
                     self.filen = newn
-                    self.collection.save()
+                    self.save()
         else:
             self.filen = filen
         return self.filen
     def info_for_button(self):
-        info = self.gameinfo
-        info['collection'] = self.collection
-        info['filepath'] = self.filen
-        info['collectionsgf'] = self
-
-        try:
-            result = info['result']
-            winner = result[0]
-            if winner in ['B','b']:
-                info['bname'] = embolden(info['bname'])
-            elif winner in ['W','w']:
-                info['wname'] = embolden(info['wname'])
-        except (KeyError, IndexError):
-            pass # If one of these keys doesn't exist, just don't modify anything
+        '''Returns the game's DisplayInfo, made once from its gameinfo and
+        remade only after set_gameinfo, or if the game has been moved to
+        another collection or file.'''
+        info = self.display_info
+        if (info is None or info['collection'] is not self.collection or
+            info['filepath'] != self.filen):
+            info = get_display_info(self)
+            self.display_info = info
         return info
         
 def jsonconvert(input):
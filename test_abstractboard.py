@@ -0,0 +1,40 @@
+'''
+Tests for AbstractBoard's bounded position cache. Run with
+
+    python -m unittest test_abstractboard
+
+'''
+
+import unittest
+
+from abstractboard import AbstractBoard, position_cache
+
+sgftext = '(;GM[1]FF[4]SZ[19];B[pd];W[dp];B[pq];W[dd];B[fq];W[cn];B[jp];W[qf];B[nc];W[rd])'
+
+class TestPositionCache(unittest.TestCase):
+    def setUp(self):
+        self.max_positions = position_cache.max_positions
+        self.boards = []
+    def tearDown(self):
+        for board in self.boards:
+            board.clear_boards()
+        position_cache.set_max_positions(self.max_positions)
+
+    def test_build_with_tiny_budget(self):
+        # With fewer positions allowed than there are open boards, a
+        # board is evicted as soon as it is stored unless it is current
+        position_cache.set_max_positions(5)
+        for i in range(60):
+            board = AbstractBoard()
+            board.load_sgf_from_text(sgftext)
+            self.boards.append(board)
+        for board in self.boards:
+            node = board.game.get_main_sequence()[-1]
+            self.assertNotEqual(board.get_position_hash(node), 0)
+            snapshot = board.get_or_build_board(node.parent)
+            self.assertEqual(snapshot.get(3, 3), 'w')
+        # Only each board's current position may be kept over budget
+        self.assertTrue(len(position_cache.entries) <= len(self.boards))
+
+if __name__ == '__main__':
+    unittest.main()